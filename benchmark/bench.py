@@ -0,0 +1,366 @@
+import argparse
+import json
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+root = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(root))
+
+import pydbus  # noqa: E402
+
+from main import Action, BluetoothExtension, ItemEnterEventListener, KeywordQueryEventListener  # noqa: E402
+from stats import stats  # noqa: E402
+
+KEYWORD = 'bt'
+WAIT_TIMEOUT = 10
+# How long to wait for the response of an action that did not start anything in the background.
+SYNC_TIMEOUT = 1
+
+
+class CountingConnection:
+    """Wraps a Gio.DBusConnection and counts the method calls made through it."""
+
+    def __init__(self, con):
+        self._con = con
+        self.calls = Counter()
+
+    def call_sync(self, bus_name, object_path, interface_name, method_name, *args):
+        self.calls[f'{interface_name}.{method_name}'] += 1
+        return self._con.call_sync(bus_name, object_path, interface_name, method_name, *args)
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+
+class Client:
+    """Collects the responses the extension pushes instead of sending them to Ulauncher."""
+
+    def __init__(self):
+        self.responses = queue.Queue()
+
+    def send(self, response):
+        self.responses.put(response)
+
+    def wait_for(self, event, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                response = self.responses.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return None
+            if response.event is event:
+                return response
+
+    def drain(self):
+        while not self.responses.empty():
+            self.responses.get_nowait()
+
+
+class Event:
+
+    def __init__(self, argument=None, data=None):
+        self.argument, self.data = argument, data
+
+    def get_keyword(self):
+        return KEYWORD
+
+    def get_argument(self):
+        return self.argument
+
+    def get_data(self):
+        return self.data
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+class Results:
+
+    def __init__(self, con):
+        self.con = con
+        self.rows = {}
+        self.failures = []
+
+    def measure(self, name, run, iterations=1):
+        latencies, calls = [], Counter()
+        for _ in range(iterations):
+            before = Counter(self.con.calls)
+            start = time.perf_counter()
+            run()
+            latencies.append((time.perf_counter() - start) * 1000)
+            calls.update(self.con.calls - before)
+        row = self.rows.setdefault(name, {'latencies': [], 'calls': Counter(), 'iterations': 0})
+        row['latencies'] += latencies
+        row['calls'].update(calls)
+        row['iterations'] += iterations
+
+    def summary(self):
+        return {name: {'n': row['iterations'],
+                       'p50': percentile(row['latencies'], 50),
+                       'p95': percentile(row['latencies'], 95),
+                       'p99': percentile(row['latencies'], 99),
+                       'max': max(row['latencies']),
+                       'calls': sum(row['calls'].values()) / row['iterations'],
+                       'methods': {method: count / row['iterations'] for method, count in row['calls'].items()}}
+                for name, row in self.rows.items()}
+
+
+def start_bus():
+    process = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address'],
+                               stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+
+def start_service(address, args):
+    process = subprocess.Popen([sys.executable, str(Path(__file__).parent / 'fake_bluez.py'), '--address', address,
+                                '--adapters', str(args.adapters), '--paired', str(args.paired),
+                                '--connected', str(args.connected), '--advertising', str(args.advertising),
+                                '--latency', str(args.latency), '--connect-latency', str(args.connect_latency)],
+                               stdout=subprocess.PIPE, text=True)
+    if process.stdout.readline().strip() != 'ready':
+        raise RuntimeError('The fake BlueZ service did not start')
+    return process
+
+
+def power_command(address, state):
+    return f'{sys.executable} {Path(__file__).parent / "fake_bluez.py"} --address {address} --power {state}'
+
+
+def make_extension(bus, address):
+    manifest = json.loads((root / 'manifest.json').read_text())
+    extension = BluetoothExtension(bus)
+    extension.preferences = {p['id']: p['default_value'] for p in manifest['preferences']}
+    extension.preferences.update(command_on=power_command(address, 'on'), command_off=power_command(address, 'off'))
+    extension._client = Client()
+    if not extension.wait_for_bluetooth(WAIT_TIMEOUT):
+        raise RuntimeError('The extension could not connect to the fake BlueZ service')
+    return extension
+
+
+def bench_screens(extension, results, args):
+    listener = KeywordQueryEventListener()
+    snapshot = extension.bt_tools.snapshot()
+    paired = next(iter(snapshot.paired))
+    screens = {'home': '', 'paired': 'paired', 'paired search': 'paired device 1', 'search': 'device 1',
+               'device': f'device {paired}', 'device_p': f'device_p {paired}',
+               'device alias': f'device {paired} alias ', 'settings': 'settings',
+               'settings discoverable': 'settings discoverable 5m', 'adapters': 'adapters', 'stats': 'stats',
+               'bulk': 'bulk', 'unpair': 'unpair'}
+
+    for name, arg in screens.items():
+        def render():
+            extension.invalidate()
+            listener.on_event(Event(arg), extension)
+
+        results.measure(f'screen {name}', render, args.iterations)
+        results.measure(f'screen {name} (memoized)', lambda: listener.on_event(Event(arg), extension), args.iterations)
+
+    extension.bt_tools.start_discovery()
+    extension.bt_tools.wait_for(lambda: len(extension.bt_tools.snapshot().nearby) >= args.advertising, WAIT_TIMEOUT)
+
+    def render_scanned():
+        extension.invalidate()
+        listener.on_event(Event('scanned'), extension)
+
+    results.measure('screen scanned', render_scanned, args.iterations)
+    extension.bt_tools.get_adapter().StopDiscovery()
+    extension.set_current(None, None)
+
+
+def run_action(extension, action, asynchronous=False, last_input='', **data):
+    event = Event(data={'keyword': KEYWORD, 'last_input': last_input, 'adapter': extension.bt_tools.get_adapter_path(),
+                        'action': action, **data})
+    extension._client.drain()
+    ItemEnterEventListener().on_event(event, extension)
+    if not asynchronous:
+        return True
+    # A handler that finds nothing to do, e.g. because an earlier action failed, answers right away instead of
+    # running the action in the background and pushing the result.
+    timeout = WAIT_TIMEOUT if extension.pending else SYNC_TIMEOUT
+    return extension._client.wait_for(event, timeout) is not None
+
+
+def bench_actions(extension, results, args):
+    bt_tools = extension.bt_tools
+    snapshot = bt_tools.snapshot()
+    device = next(address for address, d in snapshot.paired.items() if not d['Connected'])
+    adapter_path = bt_tools.get_adapter_path()
+
+    def measure(name, action, asynchronous=False, **data):
+        responded = []
+        results.measure(f'action {name}',
+                        lambda: responded.append(run_action(extension, action, asynchronous, **data)))
+        if not all(responded):
+            results.failures.append(f'action {name}: no result was pushed, the action did not run')
+
+    def settle(name, predicate):
+        if not bt_tools.wait_for(predicate, WAIT_TIMEOUT):
+            results.failures.append(f'action {name}: no effect within {WAIT_TIMEOUT} s')
+
+    def bulk(name, action, **data):
+        previous = extension.bulk
+        measure(name, action, **data)
+        settle(name, lambda: extension.bulk is not previous and extension.bulk.finished is not None)
+        if extension.bulk is not previous and extension.bulk.count('failed'):
+            results.failures.append(f'action {name}: {extension.bulk.count("failed")} devices failed')
+
+    def nearby_unpaired():
+        if not bt_tools.wait_for(lambda: any(not d['Paired'] for d in bt_tools.snapshot().nearby.values()),
+                                 WAIT_TIMEOUT):
+            results.failures.append(f'action START_SCAN: no devices found within {WAIT_TIMEOUT} s')
+            return None
+        return next(address for address, d in bt_tools.snapshot().nearby.items() if not d['Paired'])
+
+    def device_state(name, address=device):
+        return (bt_tools.get_properties(address) or {}).get(name)
+
+    def adapter_state(name):
+        return (bt_tools.get_adapter_properties() or {}).get(name)
+
+    for _ in range(args.iterations):
+        measure('RELOAD', Action.RELOAD)
+        measure('RESET_STATS', Action.RESET_STATS, last_input='stats')
+        if any(name.startswith('screen ') and name != 'screen stats' for name, _ in stats.histograms()):
+            results.failures.append('action RESET_STATS: statistics were not reset')
+        measure('SELECT_ADAPTER', Action.SELECT_ADAPTER)
+        measure('CHANGE_ADAPTER_ALIAS', Action.CHANGE_ADAPTER_ALIAS, last_input='settings alias x', alias='bench')
+        measure('CHANGE_DISCOVERABLE', Action.CHANGE_DISCOVERABLE, last_input='settings', discoverable=True)
+        settle('CHANGE_DISCOVERABLE', lambda: adapter_state('Discoverable'))
+        measure('CHANGE_DISCOVERABLE', Action.CHANGE_DISCOVERABLE, last_input='settings', discoverable=False)
+        settle('CHANGE_DISCOVERABLE', lambda: not adapter_state('Discoverable'))
+        measure('CHANGE_PAIRABLE', Action.CHANGE_PAIRABLE, last_input='settings', pairable=False)
+        settle('CHANGE_PAIRABLE', lambda: not adapter_state('Pairable'))
+        measure('CHANGE_PAIRABLE', Action.CHANGE_PAIRABLE, last_input='settings', pairable=True)
+        settle('CHANGE_PAIRABLE', lambda: adapter_state('Pairable'))
+
+        measure('CONNECT', Action.CONNECT, True, device=device, from_paired=True)
+        settle('CONNECT', lambda: device_state('Connected'))
+        measure('DISCONNECT', Action.DISCONNECT, True, device=device, from_paired=True)
+        settle('DISCONNECT', lambda: not device_state('Connected'))
+        extension.preferences['connect_profile'] = 'A2DP'
+        measure('CONNECT (A2DP)', Action.CONNECT, True, device=device, from_paired=True)
+        settle('CONNECT (A2DP)', lambda: device_state('Connected'))
+        measure('DISCONNECT', Action.DISCONNECT, True, device=device, from_paired=True)
+        settle('DISCONNECT', lambda: not device_state('Connected'))
+        bulk('CONNECT_TRUSTED (A2DP)', Action.CONNECT_TRUSTED)
+        extension.preferences['connect_profile'] = 'any'
+        bulk('DISCONNECT_ALL', Action.DISCONNECT_ALL)
+        bulk('RECONNECT_SESSION', Action.RECONNECT_SESSION)
+        bulk('DISCONNECT_ALL', Action.DISCONNECT_ALL)
+        measure('CHANGE_DEVICE_ALIAS', Action.CHANGE_DEVICE_ALIAS, device=device, from_paired=True, alias='bench')
+        for state in (True, False):
+            measure('CHANGE_DEVICE_TRUSTED', Action.CHANGE_DEVICE_TRUSTED, device=device, from_paired=True,
+                    trusted=state)
+            settle('CHANGE_DEVICE_TRUSTED', lambda: device_state('Trusted') == state)
+            measure('CHANGE_DEVICE_BLOCKED', Action.CHANGE_DEVICE_BLOCKED, device=device, from_paired=True,
+                    blocked=state)
+            settle('CHANGE_DEVICE_BLOCKED', lambda: device_state('Blocked') == state)
+            measure('TOGGLE_FAVOURITE', Action.TOGGLE_FAVOURITE, last_input=f'device_p {device}', device=device)
+            if (device in extension.favourites()) != state:
+                results.failures.append('action TOGGLE_FAVOURITE: the favourites did not change')
+
+        measure('START_SCAN', Action.START_SCAN)
+        found = nearby_unpaired()
+        if found is None:
+            break
+        measure('PAIR', Action.PAIR, True, last_input='scanned', device=found)
+        settle('PAIR', lambda: device_state('Paired', found))
+        measure('UNPAIR', Action.UNPAIR, True, device=found, from_paired=True)
+        settle('UNPAIR', lambda: not device_state('Paired', found))
+
+        found = nearby_unpaired()
+        if found is None:
+            break
+        measure('PAIR', Action.PAIR, True, last_input='scanned', device=found)
+        settle('PAIR', lambda: device_state('Paired', found))
+        measure('TOGGLE_SELECTED', Action.TOGGLE_SELECTED, last_input='unpair', device=found)
+        if found not in extension.selected:
+            results.failures.append('action TOGGLE_SELECTED: the device was not selected')
+        bulk('UNPAIR_SELECTED', Action.UNPAIR_SELECTED, last_input='unpair')
+        settle('UNPAIR_SELECTED', lambda: not device_state('Paired', found))
+        measure('STOP_SCAN', Action.STOP_SCAN)
+        settle('STOP_SCAN', lambda: not adapter_state('Discovering'))
+
+        measure('TURN_OFF', Action.TURN_OFF, True)
+        settle('TURN_OFF', lambda: not adapter_state('Powered'))
+        measure('TURN_ON', Action.TURN_ON, True, adapter=adapter_path)
+        settle('TURN_ON', lambda: adapter_state('Powered'))
+        extension.set_current(None, None)
+
+
+def print_summary(summary):
+    print(f'{"":36} {"n":>5} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"max ms":>9} {"D-Bus/op":>9}')
+    for name, row in summary.items():
+        print(f'{name:36} {row["n"]:5} {row["p50"]:9.2f} {row["p95"]:9.2f} {row["p99"]:9.2f} {row["max"]:9.2f}'
+              f' {row["calls"]:9.1f}')
+
+
+def check(summary, args, failures=()):
+    failures = list(failures)
+    for name, row in summary.items():
+        if args.max_p95 is not None and name.startswith('screen') and row['p95'] > args.max_p95:
+            failures.append(f'{name}: p95 {row["p95"]:.2f} ms > {args.max_p95} ms')
+        if args.max_screen_calls is not None and name.startswith('screen') and row['calls'] > args.max_screen_calls:
+            failures.append(f'{name}: {row["calls"]:.1f} D-Bus calls > {args.max_screen_calls}')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the extension against a fake BlueZ on a private bus.')
+    parser.add_argument('--adapters', type=int, default=1)
+    parser.add_argument('--paired', type=int, default=20, help='paired devices per adapter')
+    parser.add_argument('--connected', type=int, default=2, help='connected devices per adapter')
+    parser.add_argument('--advertising', type=int, default=50, help='devices found per adapter while scanning')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every BlueZ method call takes')
+    parser.add_argument('--connect-latency', type=float, default=0.0, help='seconds Connect and Pair take')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--skip-actions', action='store_true')
+    parser.add_argument('--json', type=Path, help='also write the results to this file')
+    parser.add_argument('--max-p95', type=float, help='fail if a screen takes longer than this many ms (p95)')
+    parser.add_argument('--max-screen-calls', type=float, help='fail if a screen makes more D-Bus calls than this')
+    args = parser.parse_args()
+
+    bus_process, address = start_bus()
+    service = None
+    # The extension keeps its settings and device cache under these, the benchmark must not touch the user's.
+    state_dir = tempfile.TemporaryDirectory(prefix='bt-bench-')
+    os.environ['XDG_CONFIG_HOME'] = os.environ['XDG_CACHE_HOME'] = state_dir.name
+    try:
+        service = start_service(address, args)
+        bus = pydbus.connect(address)
+        bus.con = con = CountingConnection(bus.con)
+        results = Results(con)
+
+        extensions = []
+        results.measure('startup', lambda: extensions.append(make_extension(bus, address)))
+        extension = extensions[0]
+        bench_screens(extension, results, args)
+        if not args.skip_actions:
+            bench_actions(extension, results, args)
+    finally:
+        for process in (service, bus_process):
+            if process is not None:
+                process.terminate()
+                process.wait()
+        state_dir.cleanup()
+
+    summary = results.summary()
+    print_summary(summary)
+    if args.json:
+        args.json.write_text(json.dumps(summary, indent=2))
+    failures = check(summary, args, results.failures)
+    for failure in failures:
+        print(f'FAIL {failure}', file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,295 @@
+import argparse
+import random
+import sys
+import time
+
+import pydbus
+from gi.repository import GLib
+from pydbus.generic import signal
+
+BLUEZ = 'org.bluez'
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+DEVICE_IFACE = 'org.bluez.Device1'
+BENCH_IFACE = 'org.bluez.test.Bench'
+
+# Property name -> (D-Bus type, writable)
+adapter_properties = {'Address': ('s', False), 'Name': ('s', False), 'Alias': ('s', True), 'Powered': ('b', True),
+                      'Discoverable': ('b', True), 'DiscoverableTimeout': ('u', True), 'Pairable': ('b', True),
+                      'PairableTimeout': ('u', True), 'Discovering': ('b', False), 'UUIDs': ('as', False)}
+device_properties = {'Address': ('s', False), 'Name': ('s', False), 'Alias': ('s', True), 'Icon': ('s', False),
+                     'Class': ('u', False), 'Paired': ('b', False), 'Trusted': ('b', True), 'Blocked': ('b', True),
+                     'Connected': ('b', False), 'Adapter': ('o', False), 'RSSI': ('n', False), 'UUIDs': ('as', False)}
+
+icons = ['audio-headset', 'audio-headphones', 'audio-card', 'input-keyboard', 'input-mouse', 'input-gaming', 'phone',
+         'computer', None]
+
+
+def introspection(iface, properties, methods='', signals=''):
+    lines = [f'<property name="{name}" type="{t}" access="{"readwrite" if writable else "read"}"/>'
+             for name, (t, writable) in properties.items()]
+    return f'<node><interface name="{iface}">{"".join(lines)}{methods}{signals}</interface></node>'
+
+
+def variants(properties, types):
+    return {name: GLib.Variant(types[name][0], value) for name, value in properties.items()}
+
+
+def bluez_property(name):
+    def get(self):
+        try:
+            return self.properties[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def set(self, value):
+        self.update(**{name: value})
+
+    return property(get, set)
+
+
+class BluezObject:
+    PropertiesChanged = signal()
+    iface, types = None, {}
+
+    def __init__(self, service, path, **properties):
+        self.service, self.path = service, path
+        self.properties = properties
+        self.registration = None
+
+    def update(self, **changed):
+        self.properties.update(changed)
+        self.PropertiesChanged(self.iface, changed, [])
+
+    def interfaces(self):
+        return {self.iface: variants(self.properties, self.types)}
+
+
+class Adapter(BluezObject):
+    iface, types = ADAPTER_IFACE, adapter_properties
+    dbus = introspection(ADAPTER_IFACE, adapter_properties, methods='''
+        <method name="StartDiscovery"/>
+        <method name="StopDiscovery"/>
+        <method name="SetDiscoveryFilter"><arg name="filter" type="a{sv}" direction="in"/></method>
+        <method name="RemoveDevice"><arg name="device" type="o" direction="in"/></method>''')
+
+    def update(self, **changed):
+        super().update(**changed)
+        if changed.get('Powered') is False:
+            if self.properties['Discovering']:
+                super().update(Discovering=False)
+            for device in list(self.service.objects.values()):
+                if isinstance(device, Device) and device.properties['Adapter'] == self.path:
+                    if device.properties['Connected']:
+                        device.update(Connected=False)
+
+    def StartDiscovery(self):
+        self.service.delay()
+        self.update(Discovering=True)
+        self.service.start_advertising(self)
+
+    def StopDiscovery(self):
+        self.service.delay()
+        self.update(Discovering=False)
+
+    def SetDiscoveryFilter(self, discovery_filter):
+        self.service.delay()
+
+    def RemoveDevice(self, path):
+        self.service.delay()
+        self.service.remove(path)
+
+
+class Device(BluezObject):
+    iface, types = DEVICE_IFACE, device_properties
+    dbus = introspection(DEVICE_IFACE, device_properties, methods='''
+        <method name="Connect"/>
+        <method name="Disconnect"/>
+        <method name="ConnectProfile"><arg name="uuid" type="s" direction="in"/></method>
+        <method name="DisconnectProfile"><arg name="uuid" type="s" direction="in"/></method>
+        <method name="Pair"/>
+        <method name="CancelPairing"/>''', signals='''
+        <signal name="Disconnected"><arg name="name" type="s"/><arg name="message" type="s"/></signal>''')
+    Disconnected = signal()
+
+    def Connect(self):
+        self.service.delay(self.service.connect_latency)
+        self.update(Connected=True)
+
+    def Disconnect(self):
+        self.service.delay()
+        self.Disconnected('org.bluez.Reason.Local', 'Connection terminated by local host')
+        self.update(Connected=False)
+
+    def ConnectProfile(self, uuid):
+        self.Connect()
+
+    def DisconnectProfile(self, uuid):
+        self.Disconnect()
+
+    def Pair(self):
+        self.service.delay(self.service.connect_latency)
+        self.update(Paired=True)
+
+    def CancelPairing(self):
+        pass
+
+
+for cls in (Adapter, Device):
+    for property_name in cls.types:
+        setattr(cls, property_name, bluez_property(property_name))
+
+
+class Bench:
+    dbus = f'''
+        <node><interface name="{BENCH_IFACE}">
+            <method name="SetPowered"><arg name="powered" type="b" direction="in"/></method>
+        </interface></node>'''
+
+    def __init__(self, service):
+        self.service = service
+
+    def SetPowered(self, powered):
+        self.service.set_powered(powered)
+
+
+class ObjectManager:
+    dbus = '''
+        <node><interface name="org.freedesktop.DBus.ObjectManager">
+            <method name="GetManagedObjects"><arg name="objects" type="a{oa{sa{sv}}}" direction="out"/></method>
+            <signal name="InterfacesAdded">
+                <arg name="object" type="o"/><arg name="interfaces" type="a{sa{sv}}"/>
+            </signal>
+            <signal name="InterfacesRemoved"><arg name="object" type="o"/><arg name="interfaces" type="as"/></signal>
+        </interface></node>'''
+    InterfacesAdded = signal()
+    InterfacesRemoved = signal()
+
+    def __init__(self, service):
+        self.service = service
+
+    def GetManagedObjects(self):
+        self.service.delay()
+        return {path: obj.interfaces() for path, obj in self.service.objects.items()}
+
+
+def address(*numbers):
+    return ':'.join(f'{n:02X}' for n in numbers)
+
+
+class FakeBluez:
+    """A stand-in org.bluez service with generated adapters and devices, for benchmarks without Bluetooth hardware."""
+
+    def __init__(self, bus, adapters=1, paired=20, connected=2, advertising=50, latency=0.0, connect_latency=0.0,
+                 advertise_interval=0.1, seed=0):
+        self.bus = bus
+        self.latency, self.connect_latency = latency, connect_latency
+        self.advertise_interval = advertise_interval
+        self.random = random.Random(seed)
+        self.objects = {}
+        self.manager = ObjectManager(self)
+        self.registrations = [bus.register_object('/', self.manager, None),
+                              bus.register_object('/org/bluez', Bench(self), None)]
+        self.adapters = [self.make_adapter(i) for i in range(adapters)]
+        self.powered = True
+        self.advertising = advertising
+        self.devices = [self.make_device(adapter, i, Paired=True, Trusted=i % 2 == 0, Connected=i < connected)
+                        for adapter in self.adapters for i in range(paired)]
+        self.advertisers = {}
+        self.advertised = 0
+        for obj in self.adapters + self.devices:
+            self.add(obj)
+
+    def make_adapter(self, i):
+        adapter = Adapter(self, f'/org/bluez/hci{i}', Address=address(0, 0x1A, 0x7D, 0xDA, 0x71, i),
+                          Name=f'bench{i}', Alias=f'bench{i}', Powered=True, Discoverable=False,
+                          DiscoverableTimeout=180, Pairable=True, PairableTimeout=0, Discovering=False, UUIDs=[])
+        adapter.number = i
+        return adapter
+
+    def make_device(self, adapter, i, **properties):
+        device_address = address(0x10 + adapter.number, 0x20, 0x30, 0x40, i // 256, i % 256)
+        properties = {'Address': device_address, 'Name': f'Device {i}', 'Alias': f'Device {i}',
+                      'Paired': False, 'Trusted': False, 'Blocked': False, 'Connected': False,
+                      'Adapter': adapter.path, 'UUIDs': [], 'Class': 0, **properties}
+        icon = icons[i % len(icons)]
+        if icon is not None:
+            properties['Icon'] = icon
+        return Device(self, f'{adapter.path}/dev_{device_address.replace(":", "_")}', **properties)
+
+    def delay(self, seconds=None):
+        seconds = self.latency if seconds is None else seconds
+        if seconds:
+            time.sleep(seconds)
+
+    def add(self, obj):
+        self.objects[obj.path] = obj
+        obj.registration = self.bus.register_object(obj.path, obj, None)
+        self.manager.InterfacesAdded(obj.path, obj.interfaces())
+
+    def remove(self, path):
+        obj = self.objects.pop(path, None)
+        if obj is None:
+            return
+        obj.registration.unregister()
+        self.manager.InterfacesRemoved(path, [obj.iface])
+        if isinstance(obj, Device):
+            self.advertisers.pop(path, None)
+
+    def set_powered(self, powered):
+        if powered == self.powered:
+            return
+        self.powered = powered
+        for adapter in self.adapters:
+            if powered:
+                self.add(adapter)
+            else:
+                for path in [p for p in self.objects if p.startswith(f'{adapter.path}/')]:
+                    self.remove(path)
+                self.remove(adapter.path)
+        if powered:
+            for device in self.devices:
+                self.add(device)
+
+    def start_advertising(self, adapter):
+        GLib.timeout_add(int(self.advertise_interval * 1000), self.advertise, adapter)
+
+    def advertise(self, adapter):
+        if not adapter.properties['Discovering'] or adapter.path not in self.objects:
+            return False
+        for path, device in list(self.advertisers.items()):
+            if path in self.objects:
+                device.update(RSSI=self.random.randint(-95, -30))
+        found = sum(1 for d in self.advertisers.values() if d.properties['Adapter'] == adapter.path)
+        if found < self.advertising:
+            self.advertised += 1
+            device = self.make_device(adapter, 1000 + self.advertised, RSSI=self.random.randint(-95, -30))
+            self.advertisers[device.path] = device
+            self.add(device)
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a fake org.bluez service on the given D-Bus bus.')
+    parser.add_argument('--address', required=True, help='address of the bus to publish on')
+    parser.add_argument('--adapters', type=int, default=1)
+    parser.add_argument('--paired', type=int, default=20, help='paired devices per adapter')
+    parser.add_argument('--connected', type=int, default=2, help='connected devices per adapter')
+    parser.add_argument('--advertising', type=int, default=50, help='devices found per adapter while scanning')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every method call takes')
+    parser.add_argument('--connect-latency', type=float, default=0.0, help='seconds Connect and Pair take')
+    parser.add_argument('--power', choices=['on', 'off'], help='switch the adapters of a running service and exit')
+    args = parser.parse_args()
+
+    bus = pydbus.connect(args.address)
+    if args.power:
+        bus.get(BLUEZ, '/org/bluez')[BENCH_IFACE].SetPowered(args.power == 'on')
+        return
+
+    FakeBluez(bus, args.adapters, args.paired, args.connected, args.advertising, args.latency, args.connect_latency)
+    bus.request_name(BLUEZ)
+    print('ready', flush=True)
+    GLib.MainLoop().run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
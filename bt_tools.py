@@ -1,53 +1,513 @@
-import re
+import bisect
+import logging
+import struct
+import threading
+import time
+from collections import OrderedDict
 
-import pydbus
-from gi.repository import GLib
+from search import SearchIndex
+from stats import InstrumentedConnection, stats
 
+BLUEZ = 'org.bluez'
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+DEVICE_IFACE = 'org.bluez.Device1'
+BATTERY_IFACE = 'org.bluez.Battery1'
+MEDIA_TRANSPORT_IFACE = 'org.bluez.MediaTransport1'
+PROPERTIES_IFACE = 'org.freedesktop.DBus.Properties'
 
-class BtTools:
+PROXY_POOL_SIZE = 32
+RSSI_SMOOTHING = 0.3
+# Devices that are not paired, trusted or connected are removed from BlueZ when they were not seen for this many
+# seconds, or when there are more of them than MAX_UNPAIRED_DEVICES. Checked every EXPIRY_INTERVAL seconds.
+DEVICE_TTL = 300
+MAX_UNPAIRED_DEVICES = 200
+EXPIRY_INTERVAL = 60
+
+# Audio profile UUIDs a media transport can use -> short name
+audio_profiles = {'0000110a-0000-1000-8000-00805f9b34fb': 'A2DP source',
+                  '0000110b-0000-1000-8000-00805f9b34fb': 'A2DP',
+                  '00001108-0000-1000-8000-00805f9b34fb': 'HSP',
+                  '00001112-0000-1000-8000-00805f9b34fb': 'HSP',
+                  '0000111e-0000-1000-8000-00805f9b34fb': 'HFP',
+                  '0000111f-0000-1000-8000-00805f9b34fb': 'HFP',
+                  '00008f1c-0000-1000-8000-00805f9b34fb': 'LE Audio',
+                  '00008f1d-0000-1000-8000-00805f9b34fb': 'LE Audio'}
+
+RFKILL_DEVICE = '/dev/rfkill'
+# struct rfkill_event from linux/rfkill.h: idx, type, op, soft, hard
+RFKILL_EVENT = struct.Struct('=IBBBB')
+RFKILL_TYPE_BLUETOOTH = 2
+RFKILL_OP_CHANGE_ALL = 3
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_address(address: str):
+    return address.replace('_', ':').upper()
+
+
+def adapter_name(path: str):
+    return path.rsplit('/', 1)[-1]
+
+
+def set_rfkill(blocked: bool):
+    with open(RFKILL_DEVICE, 'wb', buffering=0) as f:
+        f.write(RFKILL_EVENT.pack(0, RFKILL_TYPE_BLUETOOTH, RFKILL_OP_CHANGE_ALL, int(blocked), 0))
+
+
+class RssiRanking:
+
+    def __init__(self, smoothing=RSSI_SMOOTHING):
+        self._smoothing = smoothing
+        self._rssi = {}
+        # (-smoothed RSSI, path), strongest signal first.
+        self._order = []
+
+    def update(self, path, rssi):
+        old = self._rssi.get(path)
+        if old is not None:
+            self._remove(path, old)
+            rssi = old + self._smoothing * (rssi - old)
+        self._rssi[path] = rssi
+        bisect.insort(self._order, (-rssi, path))
+
+    def discard(self, path):
+        old = self._rssi.pop(path, None)
+        if old is not None:
+            self._remove(path, old)
+
+    def clear(self):
+        self._rssi.clear()
+        self._order.clear()
+
+    def _remove(self, path, rssi):
+        del self._order[bisect.bisect_left(self._order, (-rssi, path))]
 
-    def __init__(self):
-        self._bus = pydbus.SystemBus()
-        self._manager = self._bus.get('org.bluez', '/')
-        self._adapter = None
-        self._pattern = re.compile('\\/org\\/bluez\\/hci\\d*\\/dev\\_(.*)')
+    def top(self, prefix, limit):
+        result = []
+        for rssi, path in self._order:
+            if len(result) >= limit:
+                break
+            if path.startswith(prefix):
+                result.append((path, -rssi))
+        return result
 
-    def get_devices(self):
-        items = {}
-        for key, value in self._manager.GetManagedObjects().items():
-            if 'org.bluez.Device1' not in value:
+
+class DeviceRecord:
+    """The Device1 properties the screens use; UUIDs, manufacturer and service data and the rest are dropped.
+
+    Supports the read-only part of the dict interface, with optional properties that are missing reading as absent.
+    Records are replaced instead of mutated, like the property dicts of the other interfaces.
+    """
+    __slots__ = ('Address', 'Alias', 'Name', 'Icon', 'Adapter', 'Paired', 'Trusted', 'Blocked', 'Connected', 'RSSI',
+                 'last_seen')
+    fields = frozenset(__slots__) - {'last_seen'}
+
+    def __init__(self, properties, last_seen):
+        self.Address, self.Adapter = properties['Address'], properties['Adapter']
+        self.Alias = properties.get('Alias', self.Address)
+        self.Name, self.Icon, self.RSSI = properties.get('Name'), properties.get('Icon'), properties.get('RSSI')
+        self.Paired, self.Trusted = properties.get('Paired', False), properties.get('Trusted', False)
+        self.Blocked, self.Connected = properties.get('Blocked', False), properties.get('Connected', False)
+        # time.monotonic() of the last signal about the device.
+        self.last_seen = last_seen
+
+    def __getitem__(self, name):
+        value = getattr(self, name) if name in self.fields else None
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        value = getattr(self, name) if name in self.fields else None
+        return default if value is None else value
+
+    def __contains__(self, name):
+        return name in self.fields and getattr(self, name) is not None
+
+    def updated(self, changed, invalidated, now):
+        record = DeviceRecord.__new__(DeviceRecord)
+        for name in self.__slots__:
+            setattr(record, name, getattr(self, name))
+        for name, value in changed.items():
+            if name in self.fields:
+                setattr(record, name, value)
+        for name in invalidated:
+            if name in ('Name', 'Icon', 'RSSI'):
+                setattr(record, name, None)
+        # Only invalidating properties (e.g. RSSI once the device is out of range) does not mean it was seen.
+        if changed:
+            record.last_seen = now
+        return record
+
+
+class Snapshot:
+
+    def __init__(self, objects, adapter_path, ranked=()):
+        self.adapter_path = adapter_path
+        self.adapters = {}
+        self.devices, self.connected, self.paired, self.nearby = {}, {}, {}, {}
+        self.by_path = {}
+        # Battery1 and MediaTransport1 come with the same objects, so they cost no extra D-Bus calls.
+        batteries, transports = {}, {}
+        for path, interfaces in objects:
+            if ADAPTER_IFACE in interfaces:
+                self.adapters[path] = interfaces[ADAPTER_IFACE]
+                continue
+            if BATTERY_IFACE in interfaces:
+                batteries[path] = interfaces[BATTERY_IFACE].get('Percentage')
+            transport = interfaces.get(MEDIA_TRANSPORT_IFACE)
+            if transport is not None and 'Device' in transport:
+                # A device can have several transports, prefer the one that is streaming.
+                if transport.get('State') == 'active' or transport['Device'] not in transports:
+                    transports[transport['Device']] = transport
+
+            device = interfaces.get(DEVICE_IFACE)
+            if device is None or device['Adapter'] != adapter_path:
                 continue
 
-            m = self._pattern.match(key)
-            if m is not None:
-                items[m.group(1)] = value['org.bluez.Device1']
-        return items
+            address = device['Address']
+            self.devices[address] = device
+            self.by_path[path] = device
+            if device['Connected']:
+                self.connected[address] = device
+            if device['Paired']:
+                self.paired[address] = device
+            if 'RSSI' in device:
+                self.nearby[address] = device
+        self.adapter = self.adapters.get(adapter_path)
+        # Address -> battery percentage and address -> (audio profile, whether it is streaming)
+        self.battery = {self.by_path[path]['Address']: percentage for path, percentage in batteries.items()
+                        if path in self.by_path and percentage is not None}
+        self.media = {self.by_path[path]['Address']: (audio_profiles.get(t.get('UUID', '').lower(), 'Audio'),
+                                                      t.get('State') == 'active')
+                      for path, t in transports.items() if path in self.by_path}
+        # Nearby devices with their smoothed RSSI, strongest signal first.
+        self.ranked = [(self.by_path[path], rssi) for path, rssi in ranked if path in self.by_path]
+
+
+class BtTools:
+
+    def __init__(self, bus=None):
+        # pydbus and GLib are only imported here, so that importing this module stays cheap at startup.
+        import pydbus
+        from gi.repository import GLib
+
+        self._bus = bus or pydbus.SystemBus()
+        self._bus.con = InstrumentedConnection(self._bus.con, stats)
+        self._manager = self._bus.get(BLUEZ, '/')
 
-    def get_nearby_devices(self):
-        return {k: v for k, v in self.get_devices().items() if 'RSSI' in v}
+        # Object path -> interface -> properties, kept current from the ObjectManager and PropertiesChanged signals.
+        # Property dicts are replaced instead of mutated, so references handed out stay consistent.
+        self._lock = threading.RLock()
+        self._changed = threading.Condition(self._lock)
+        self._objects = {}
+        # Advances on every change to the cached state, so renders can be memoized against it.
+        self.generation = 0
+        # Adapter paths and (adapter path, address) -> device path, maintained alongside the object cache.
+        self._adapters = set()
+        self._device_paths = {}
+        self._selected_adapter = None
+        self._ranking = RssiRanking()
+        self._search = SearchIndex()
+        # Introspected proxies by object path, least recently used first.
+        self._proxies = OrderedDict()
+        # Paths of the devices that may be evicted, least recently seen first.
+        self._unpaired = OrderedDict()
+        # Device path -> reason of the last disconnection (e.g. 'org.bluez.Reason.Remote') until it connects again.
+        # BlueZ only reports reasons since 5.82, with the Device1.Disconnected signal.
+        self._disconnect_reasons = {}
+        # Called as listener(path, iface, changed) after each cache update; changed is None if the interface was
+        # removed, and all three are None after the whole tree was reloaded.
+        self._listeners = []
 
-    def get_connected_devices(self):
-        return {k: v for k, v in self.get_devices().items() if v['Connected']}
+        self._manager.InterfacesAdded.connect(self._on_interfaces_added)
+        self._manager.InterfacesRemoved.connect(self._on_interfaces_removed)
+        self._bus.subscribe(sender=BLUEZ, iface=PROPERTIES_IFACE, signal='PropertiesChanged',
+                            signal_fired=self._on_properties_changed)
+        self._bus.subscribe(sender=BLUEZ, iface=DEVICE_IFACE, signal='Disconnected',
+                            signal_fired=self._on_disconnected)
+        self._bus.dbus.NameOwnerChanged.connect(self._on_name_owner_changed)
+        self._loop = GLib.MainLoop()
+        threading.Thread(target=self._loop.run, name='bt-tools-signals', daemon=True).start()
+        self._load_objects()
+        self._schedule_expiry()
 
-    def get_paired_devices(self):
-        return {k: v for k, v in self.get_devices().items() if v['Paired']}
+    def _index(self, path, interfaces):
+        if ADAPTER_IFACE in interfaces:
+            self._adapters.add(path)
+        if DEVICE_IFACE in interfaces:
+            device = interfaces[DEVICE_IFACE] = DeviceRecord(interfaces[DEVICE_IFACE], time.monotonic())
+            self._device_paths[(device['Adapter'], device['Address'])] = path
+            if 'RSSI' in device:
+                self._ranking.update(path, device['RSSI'])
+            self._search.update(path, device.get('Alias'), device.get('Name'), device['Address'])
+            self._track(path, device, seen=True)
 
-    def get_device(self, dev: str):
-        try:
-            return self._bus.get('org.bluez', f'/org/bluez/hci0/dev_{dev.replace(":", "_")}')
-        except KeyError:
-            return None
+    def _track(self, path, device, seen):
+        if device.Paired or device.Trusted or device.Connected:
+            self._unpaired.pop(path, None)
+            return
+        self._unpaired[path] = device.last_seen
+        if seen:
+            self._unpaired.move_to_end(path)
 
-    def get_adapter(self):
-        if '/org/bluez/hci0' in self._manager.GetManagedObjects():
-            if self._adapter is not None:
-                return self._adapter
+    def _expired(self):
+        # Called with the lock held, returns the devices to remove from BlueZ and stops tracking them.
+        deadline = time.monotonic() - DEVICE_TTL
+        expired = []
+        while self._unpaired:
+            path, last_seen = next(iter(self._unpaired.items()))
+            if last_seen >= deadline and len(self._unpaired) <= MAX_UNPAIRED_DEVICES:
+                break
+            del self._unpaired[path]
+            expired.append(path)
+        return expired
+
+    def _schedule_expiry(self):
+        timer = threading.Timer(EXPIRY_INTERVAL, self._expire)
+        timer.daemon = True
+        timer.start()
+
+    def _expire(self):
+        with self._lock:
+            expired = self._expired()
+        self._evict(expired)
+        self._schedule_expiry()
+
+    def _evict(self, paths):
+        if not paths:
+            return
+
+        def remove():
+            for path in paths:
+                adapter = self.get_adapter(path.rsplit('/', 1)[0])
+                if adapter is None:
+                    continue
+                # noinspection PyBroadException
+                try:
+                    adapter.RemoveDevice(path)
+                except Exception:
+                    logger.debug('Could not remove stale device %s', path, exc_info=True)
+
+        logger.debug('Removing %d stale devices', len(paths))
+        threading.Thread(target=remove, name='bt-evict', daemon=True).start()
+
+    def _load_objects(self):
+        from gi.repository import GLib
+
+        with self._lock, stats.span('bt load objects'):
+            try:
+                self._objects = self._manager.GetManagedObjects()
+            except GLib.Error:
+                self._objects = {}
+            self._adapters.clear()
+            self._device_paths.clear()
+            self._ranking.clear()
+            self._search.clear()
+            self._unpaired.clear()
+            self._disconnect_reasons.clear()
+            for path, interfaces in self._objects.items():
+                self._index(path, interfaces)
+            self._proxies.clear()
+            self._touch()
+        self._notify(None, None, None)
+
+    def _on_interfaces_added(self, path, interfaces):
+        with self._lock, stats.span('bt signal InterfacesAdded'):
+            indexed = dict(interfaces)
+            self._index(path, indexed)
+            self._objects[path] = {**self._objects.get(path, {}), **indexed}
+            self._touch()
+        for iface, properties in interfaces.items():
+            self._notify(path, iface, properties)
+
+    def _on_interfaces_removed(self, path, interfaces):
+        with self._lock, stats.span('bt signal InterfacesRemoved'):
+            if path not in self._objects:
+                return
+            removed = self._objects[path]
+            remaining = {k: v for k, v in removed.items() if k not in interfaces}
+            if remaining:
+                self._objects[path] = remaining
             else:
-                self._adapter = self._bus.get('org.bluez', '/org/bluez/hci0')
-                return self._adapter
-        else:
-            self._adapter = None
-            return None
+                del self._objects[path]
+            if ADAPTER_IFACE in interfaces:
+                self._adapters.discard(path)
+                prefix = path + '/'
+                for proxy_path in [p for p in self._proxies if p == path or p.startswith(prefix)]:
+                    del self._proxies[proxy_path]
+            elif DEVICE_IFACE in interfaces:
+                self._proxies.pop(path, None)
+            if DEVICE_IFACE in interfaces and DEVICE_IFACE in removed:
+                device = removed[DEVICE_IFACE]
+                self._device_paths.pop((device['Adapter'], device['Address']), None)
+                self._ranking.discard(path)
+                self._search.discard(path)
+                self._unpaired.pop(path, None)
+                self._disconnect_reasons.pop(path, None)
+            self._touch()
+        for iface in interfaces:
+            self._notify(path, iface, None)
+
+    def _on_properties_changed(self, sender, path, iface, signal, params):
+        changed_iface, changed, invalidated = params
+        with self._lock, stats.span('bt signal PropertiesChanged'):
+            interfaces = self._objects.get(path)
+            if interfaces is None or changed_iface not in interfaces:
+                return
+            if changed_iface == DEVICE_IFACE:
+                properties = interfaces[changed_iface].updated(changed, invalidated, time.monotonic())
+                if 'RSSI' in changed:
+                    self._ranking.update(path, changed['RSSI'])
+                elif 'RSSI' in invalidated:
+                    self._ranking.discard(path)
+                if 'Alias' in changed or 'Name' in changed:
+                    self._search.update(path, properties.get('Alias'), properties.get('Name'), properties['Address'])
+                self._track(path, properties, seen=bool(changed))
+                if changed.get('Connected'):
+                    self._disconnect_reasons.pop(path, None)
+            else:
+                properties = {**interfaces[changed_iface], **changed}
+                for name in invalidated:
+                    properties.pop(name, None)
+                if changed_iface == ADAPTER_IFACE and changed.get('Powered'):
+                    # Turning the adapter off disconnected its devices, whatever reason BlueZ gave.
+                    prefix = path + '/'
+                    for device_path in [p for p in self._disconnect_reasons if p.startswith(prefix)]:
+                        del self._disconnect_reasons[device_path]
+            interfaces[changed_iface] = properties
+            self._touch()
+        self._notify(path, changed_iface, changed)
+
+    def _on_disconnected(self, sender, path, iface, signal, params):
+        # Sent right before Connected changes to false.
+        reason, _ = params
+        with self._lock:
+            self._disconnect_reasons[path] = reason
+
+    def get_disconnect_reason(self, path):
+        with self._lock:
+            return self._disconnect_reasons.get(path)
+
+    def _on_name_owner_changed(self, name, old_owner, new_owner):
+        if name == BLUEZ:
+            self._load_objects()
+
+    def _touch(self):
+        self.generation += 1
+        self._changed.notify_all()
+
+    def _notify(self, path, iface, changed):
+        for listener in self._listeners:
+            # noinspection PyBroadException
+            try:
+                listener(path, iface, changed)
+            except Exception:
+                logger.exception('Bluetooth state listener failed')
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def wait_for(self, predicate, timeout):
+        with self._changed:
+            return self._changed.wait_for(predicate, timeout)
+
+    def get_adapter_path(self):
+        with self._lock:
+            if self._selected_adapter in self._adapters:
+                return self._selected_adapter
+            return min(self._adapters, key=lambda p: (len(p), p), default=None)
+
+    def select_adapter(self, path):
+        with self._lock:
+            self._selected_adapter = path
+            self._touch()
+
+    def snapshot(self, adapter_path=None, nearby_limit=0):
+        with stats.span('bt snapshot'):
+            with self._lock:
+                objects = list(self._objects.items())
+                adapter_path = adapter_path or self.get_adapter_path()
+                ranked = self._ranking.top(f'{adapter_path}/', nearby_limit) if adapter_path and nearby_limit else ()
+            return Snapshot(objects, adapter_path, ranked)
+
+    def search(self, query: str, adapter_path=None):
+        with self._lock:
+            prefix = f'{adapter_path or self.get_adapter_path()}/'
+            return [path for path in self._search.search(query) if path.startswith(prefix)]
+
+    def get_adapter_properties(self, adapter_path=None):
+        with self._lock:
+            return self._objects.get(adapter_path or self.get_adapter_path(), {}).get(ADAPTER_IFACE)
+
+    def is_powered(self, adapter_path=None):
+        properties = self.get_adapter_properties(adapter_path)
+        return properties is not None and properties.get('Powered', True)
+
+    def set_powered(self, powered, adapter_path=None, rfkill=False, timeout=5):
+        # Completion is taken from the signals that update the cache, not from polling BlueZ.
+        if powered and (rfkill or self.get_adapter_properties(adapter_path) is None):
+            set_rfkill(False)
+            if not self.wait_for(lambda: self.get_adapter_properties(adapter_path) is not None, timeout):
+                raise TimeoutError('No Bluetooth adapter appeared after unblocking it')
+        adapter = self.get_adapter(adapter_path)
+        if adapter is not None:
+            adapter.Powered = powered
+        if not powered and rfkill:
+            set_rfkill(True)
+        if not self.wait_for(lambda: self.is_powered(adapter_path) == powered, timeout):
+            raise TimeoutError(f'The Bluetooth adapter did not turn {"on" if powered else "off"}')
+
+    def get_object_properties(self, path, iface):
+        with self._lock:
+            return self._objects.get(path, {}).get(iface)
+
+    def get_device_path(self, address: str, adapter_path=None):
+        with self._lock:
+            return self._device_paths.get((adapter_path or self.get_adapter_path(), normalize_address(address)))
+
+    def get_properties(self, address: str, adapter_path=None):
+        with self._lock:
+            return self._objects.get(self.get_device_path(address, adapter_path), {}).get(DEVICE_IFACE)
+
+    def _get_proxy(self, path, iface):
+        with self._lock:
+            if iface not in self._objects.get(path, {}):
+                self._proxies.pop(path, None)
+                return None
+            proxy = self._proxies.get(path)
+            if proxy is not None:
+                self._proxies.move_to_end(path)
+                return proxy
+
+        with stats.span('bt create proxy'):
+            proxy = self._bus.get(BLUEZ, path)
+        with self._lock:
+            self._proxies[path] = proxy
+            if len(self._proxies) > PROXY_POOL_SIZE:
+                self._proxies.popitem(last=False)
+        return proxy
+
+    def get_device(self, address: str, adapter_path=None):
+        return self._get_proxy(self.get_device_path(address, adapter_path), DEVICE_IFACE)
+
+    def get_adapter(self, adapter_path=None):
+        return self._get_proxy(adapter_path or self.get_adapter_path(), ADAPTER_IFACE)
+
+    def start_discovery(self, adapter_path=None, transport='auto', rssi=None, duplicate_data=False):
+        from gi.repository import GLib
+
+        adapter = self.get_adapter(adapter_path)
+        if adapter is None:
+            return False
+        discovery_filter = {'Transport': GLib.Variant('s', transport),
+                            'DuplicateData': GLib.Variant('b', duplicate_data)}
+        if rssi is not None:
+            discovery_filter['RSSI'] = GLib.Variant('n', rssi)
+        adapter.SetDiscoveryFilter(discovery_filter)
+        adapter.StartDiscovery()
+        return True
 
 
 if __name__ == '__main__':
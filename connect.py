@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from stats import Histogram, stats
+
+# Profiles offered by the "Connect profile" preference, as the UUIDs headsets and speakers advertise for them.
+profiles = {'A2DP': '0000110b-0000-1000-8000-00805f9b34fb',
+            'HFP': '0000111e-0000-1000-8000-00805f9b34fb',
+            'HSP': '00001108-0000-1000-8000-00805f9b34fb'}
+profile_names = {uuid: name for name, uuid in profiles.items()}
+profile_names['Connect'] = 'all profiles'
+
+MAX_DEVICES = 100
+# Attempts needed before the statistics of a method change how it is tried.
+MIN_SAMPLES = 5
+# A profile connection that failed more often than this is skipped in favour of the generic Connect().
+MAX_FAILURE_RATE = 0.5
+# A profile connection gets this many times its 95th percentile latency before Connect() is tried instead.
+TIMEOUT_FACTOR = 2
+MIN_TIMEOUT = 1
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectStats:
+    """Latency and failures of connection attempts per device and method, for the MAX_DEVICES most recent devices."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Address -> method ('Connect' or a profile UUID) -> [latency histogram of the successes, failures]
+        self._devices = OrderedDict()
+
+    def record(self, address, method, ms, ok):
+        with self._lock:
+            methods = self._devices.pop(address, {})
+            self._devices[address] = methods
+            if len(self._devices) > MAX_DEVICES:
+                self._devices.popitem(last=False)
+            entry = methods.get(method)
+            if entry is None:
+                entry = methods[method] = [Histogram(), 0]
+            if ok:
+                entry[0].add(ms)
+            else:
+                entry[1] += 1
+        stats.add(f'connect {profile_names.get(method, method)}{"" if ok else " failed"}', ms)
+
+    def reset(self):
+        with self._lock:
+            self._devices.clear()
+
+    def get(self, address, method):
+        with self._lock:
+            histogram, failures = self._devices.get(address, {}).get(method, (None, 0))
+            return histogram, failures
+
+    def timeout(self, address, method, budget):
+        """Returns how long to wait for the method, or 0 if it fails too often to be worth trying."""
+        histogram, failures = self.get(address, method)
+        attempts = failures + (histogram.count if histogram else 0)
+        if attempts < MIN_SAMPLES:
+            return budget
+        if failures / attempts > MAX_FAILURE_RATE:
+            return 0
+        return min(budget, max(MIN_TIMEOUT, histogram.percentile(95) / 1000 * TIMEOUT_FACTOR))
+
+    def summary(self, address):
+        with self._lock:
+            methods = list(self._devices.get(address, {}).items())
+        lines = []
+        for method, (histogram, failures) in sorted(methods):
+            attempts = histogram.count + failures
+            line = f'Connect {profile_names.get(method, method)}: {histogram.count}/{attempts} succeeded'
+            if histogram.count:
+                line += f', p50 <= {histogram.percentile(50):.0f} ms, p95 <= {histogram.percentile(95):.0f} ms'
+            lines.append(line)
+        return lines
+
+
+connect_stats = ConnectStats()
+
+
+def connect(bt_tools, address, adapter_path=None, profile=None, timeout=5):
+    """Connects the device within timeout seconds, with ConnectProfile(profile) first if a profile UUID is given.
+
+    Connect() is tried when the profile connection fails, or takes much longer than it used to for the device.
+    """
+    deadline = time.monotonic() + timeout
+    methods = [profile, 'Connect'] if profile else ['Connect']
+    error = None
+    for method in methods:
+        budget = deadline - time.monotonic()
+        if method != 'Connect':
+            budget = connect_stats.timeout(address, method, budget)
+        if budget <= 0:
+            continue
+        device = bt_tools.get_device(address, adapter_path)
+        if device is None:
+            raise LookupError('The device is gone')
+        start = time.perf_counter()
+        # noinspection PyBroadException
+        try:
+            if method == 'Connect':
+                device.Connect(timeout=budget)
+            else:
+                device.ConnectProfile(method, timeout=budget)
+        except Exception as e:
+            connect_stats.record(address, method, (time.perf_counter() - start) * 1000, False)
+            logger.info('%s of %s failed', method, address, exc_info=True)
+            error = e
+            # A profile connection that timed out may still have gone through.
+            if (bt_tools.get_properties(address, adapter_path) or {}).get('Connected'):
+                return
+            continue
+        connect_stats.record(address, method, (time.perf_counter() - start) * 1000, True)
+        return
+    raise error or TimeoutError(f'Could not connect {address} within {timeout} s')
@@ -0,0 +1,158 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from bt_tools import ADAPTER_IFACE, DEVICE_IFACE, Snapshot, normalize_address
+
+FLUSH_DELAY = 5
+MAX_DEVICES = 500
+# Devices that are not paired are forgotten after this many seconds without being seen.
+MAX_AGE = 30 * 24 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS adapters (
+    path TEXT PRIMARY KEY,
+    address TEXT NOT NULL,
+    alias TEXT NOT NULL,
+    powered INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS devices (
+    adapter TEXT NOT NULL,
+    address TEXT NOT NULL,
+    alias TEXT NOT NULL,
+    name TEXT,
+    icon TEXT,
+    paired INTEGER NOT NULL,
+    trusted INTEGER NOT NULL,
+    rssi INTEGER,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (adapter, address)
+) WITHOUT ROWID;
+'''
+
+
+def cache_dir():
+    return Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'ulauncher-bluetooth'
+
+
+class DeviceCache:
+    """Keeps the adapters and devices BlueZ knows in sqlite, so screens can be rendered before BlueZ is connected."""
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else cache_dir() / 'devices.sqlite'
+        self._lock = threading.Lock()
+        self._db = None
+        self._bt_tools = None
+        # Object paths changed since the last flush, and whether the whole tree has to be written because it was
+        # (re)loaded. Both are kept until the flush, so a reload does not drop removals queued before it.
+        self._dirty = set()
+        self._full = False
+        self._flush_timer = None
+
+    def _connect(self):
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def snapshot(self):
+        with self._lock:
+            try:
+                db = self._connect()
+                adapters = db.execute('SELECT path, address, alias, powered FROM adapters').fetchall()
+                devices = db.execute('SELECT adapter, address, alias, name, icon, paired, trusted FROM devices'
+                                     ' WHERE paired ORDER BY alias').fetchall()
+            except sqlite3.Error:
+                logger.warning('Could not read the device cache', exc_info=True)
+                return None
+        if not adapters:
+            return None
+
+        objects = [(path, {ADAPTER_IFACE: {'Address': address, 'Alias': alias, 'Powered': bool(powered),
+                                           'Discovering': False, 'Discoverable': False, 'Pairable': False}})
+                   for path, address, alias, powered in adapters]
+        for adapter, address, alias, name, icon, paired, trusted in devices:
+            device = {'Address': address, 'Alias': alias, 'Adapter': adapter, 'Paired': bool(paired),
+                      'Trusted': bool(trusted), 'Connected': False, 'Blocked': False}
+            if name is not None:
+                device['Name'] = name
+            if icon is not None:
+                device['Icon'] = icon
+            objects.append((f'{adapter}/dev_{address.replace(":", "_")}', {DEVICE_IFACE: device}))
+        adapter_path = min((path for path, *_ in adapters), key=lambda p: (len(p), p))
+        return Snapshot(objects, adapter_path)
+
+    def attach(self, bt_tools):
+        self._bt_tools = bt_tools
+        bt_tools.add_listener(self._on_state_changed)
+        self._on_state_changed(None, None, None)
+
+    def _on_state_changed(self, path, iface, changed):
+        if iface not in (DEVICE_IFACE, ADAPTER_IFACE, None):
+            return
+        with self._lock:
+            if path is None:
+                self._full = True
+            else:
+                self._dirty.add(path)
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(FLUSH_DELAY, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush(self):
+        with self._lock:
+            dirty, full = self._dirty, self._full
+            self._dirty, self._full, self._flush_timer = set(), False, None
+        snapshot = self._bt_tools.snapshot()
+        now = time.time()
+        adapters, devices, gone, live = [], [], [], set()
+        for path, properties in snapshot.adapters.items():
+            adapters.append((path, properties['Address'], properties['Alias'], properties.get('Powered', True)))
+        for adapter_path in snapshot.adapters:
+            for path, device in self._bt_tools.snapshot(adapter_path).by_path.items():
+                live.add((adapter_path, device['Address']))
+                if not full and path not in dirty:
+                    continue
+                seen = 'RSSI' in device or device['Connected']
+                devices.append((adapter_path, device['Address'], device['Alias'], device.get('Name'),
+                                device.get('Icon'), device['Paired'], device['Trusted'], device.get('RSSI'),
+                                now if seen else 0))
+        for path in dirty:
+            adapter_path, _, name = path.rpartition('/')
+            # A device that disappeared while its adapter is still there was unpaired or expired; if the adapter went
+            # away too, the device is still paired and kept as it was.
+            removed = self._bt_tools.get_object_properties(path, DEVICE_IFACE) is None
+            if name.startswith('dev_') and adapter_path in snapshot.adapters and removed:
+                gone.append((adapter_path, normalize_address(name[len('dev_'):])))
+
+        with self._lock:
+            db = None
+            try:
+                db = self._connect()
+                db.execute('BEGIN')
+                db.executemany('INSERT OR REPLACE INTO adapters VALUES (?, ?, ?, ?)', adapters)
+                if full:
+                    # Devices unpaired while the extension was not running are only noticed by their absence.
+                    paired = db.execute('SELECT adapter, address FROM devices WHERE paired').fetchall()
+                    gone.extend(row for row in paired if row[0] in snapshot.adapters and row not in live)
+                db.executemany('INSERT INTO devices VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+                               ' ON CONFLICT (adapter, address) DO UPDATE SET alias = excluded.alias,'
+                               ' name = excluded.name, icon = excluded.icon, paired = excluded.paired,'
+                               ' trusted = excluded.trusted, rssi = COALESCE(excluded.rssi, rssi),'
+                               ' last_seen = MAX(last_seen, excluded.last_seen)', devices)
+                db.executemany('UPDATE devices SET paired = 0 WHERE adapter = ? AND address = ?', gone)
+                db.execute('DELETE FROM devices WHERE NOT paired AND last_seen < ?', (now - MAX_AGE,))
+                db.execute('DELETE FROM devices WHERE (adapter, address) NOT IN (SELECT adapter, address FROM devices'
+                           ' ORDER BY paired DESC, last_seen DESC LIMIT ?)', (MAX_DEVICES,))
+                db.execute('COMMIT')
+            except sqlite3.Error:
+                logger.warning('Could not write the device cache', exc_info=True)
+                if db is not None and db.in_transaction:
+                    db.execute('ROLLBACK')
@@ -0,0 +1,41 @@
+import math
+import threading
+import time
+
+HALF_LIFE = 3 * 24 * 60 * 60
+DECAY = math.log(2) / HALF_LIFE
+MAX_DEVICES = 200
+
+
+class Frecency:
+    """Time-decayed usage score per device address.
+
+    The score of a device is the sum of exp(-DECAY * age) over its uses. Only ln(sum of exp(DECAY * time of use)) is
+    stored; it differs from the log of the score at any moment by the same DECAY * now for every device, so it can be
+    compared directly and never has to be decayed.
+    """
+
+    def __init__(self, settings):
+        self._settings = settings
+        self._lock = threading.Lock()
+        self._ranks = dict(settings.get('frecency', {}))
+
+    def record(self, address, now=None):
+        point = DECAY * (time.time() if now is None else now)
+        with self._lock:
+            old = self._ranks.get(address)
+            if old is None:
+                rank = point
+            else:
+                rank = max(old, point) + math.log1p(math.exp(-abs(old - point)))
+            self._ranks[address] = rank
+            if len(self._ranks) > MAX_DEVICES:
+                del self._ranks[min(self._ranks, key=self._ranks.get)]
+            ranks = dict(self._ranks)
+        self._settings.set('frecency', ranks)
+
+    def rank(self, address):
+        return self._ranks.get(address, -math.inf)
+
+    def sort(self, devices):
+        return sorted(devices, key=lambda device: -self.rank(device['Address']))
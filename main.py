@@ -1,9 +1,13 @@
+import logging
+import math
 import re
 import shlex
 import subprocess
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from functools import cmp_to_key
 from pathlib import Path
 
 from ulauncher.api.client.EventListener import EventListener
@@ -12,23 +16,62 @@ from ulauncher.api.shared.action.DoNothingAction import DoNothingAction
 from ulauncher.api.shared.action.ExtensionCustomAction import ExtensionCustomAction
 from ulauncher.api.shared.action.RenderResultListAction import RenderResultListAction
 from ulauncher.api.shared.action.SetUserQueryAction import SetUserQueryAction
-from ulauncher.api.shared.event import KeywordQueryEvent, ItemEnterEvent
+from ulauncher.api.shared.event import KeywordQueryEvent, ItemEnterEvent, PreferencesEvent, PreferencesUpdateEvent
+from ulauncher.api.shared.Response import Response
 from ulauncher.api.shared.item.ExtensionResultItem import ExtensionResultItem
-from wrapt_timeout_decorator import timeout
 
-from bt_tools import BtTools
+from bt_tools import ADAPTER_IFACE, DEVICE_IFACE, BtTools, adapter_name, normalize_address
+from connect import connect, connect_stats, profiles
+from device_cache import DeviceCache
+from frecency import Frecency
+from reconnect import AutoReconnect
+from router import Converter, Router
+from scan import ScanManager
+from stats import stats
+from storage import Settings
+
+logger = logging.getLogger(__name__)
 
 images_path = Path(__file__).parent / 'images'
 
+ACTION_TIMEOUT = 5
+ACTION_WORKERS = 8
+STREAM_REFRESH_INTERVAL = 1
+DEFAULT_SCAN_LIMIT = 30
+DEFAULT_SCAN_DURATION = 60
+DEFAULT_BULK_PARALLELISM = 4
+RENDER_CACHE_SIZE = 64
 
-def wait(condition, check_condition, wait_timeout):
-    max_count, count = wait_timeout / check_condition, 0
-    while condition():
-        time.sleep(check_condition)
-        count += 1
-        if count >= max_count:
-            return False
-    return True
+
+class Action(Enum):
+    RELOAD = 1
+    TURN_ON = 2
+    TURN_OFF = 3
+    CHANGE_ADAPTER_ALIAS = 4
+    CHANGE_DISCOVERABLE = 5
+    CHANGE_PAIRABLE = 6
+    START_SCAN = 7
+    STOP_SCAN = 8
+    CONNECT = 9
+    DISCONNECT = 10
+    PAIR = 11
+    UNPAIR = 12
+    CHANGE_DEVICE_ALIAS = 13
+    CHANGE_DEVICE_TRUSTED = 14
+    CHANGE_DEVICE_BLOCKED = 15
+    SELECT_ADAPTER = 16
+    RESET_STATS = 17
+    CONNECT_TRUSTED = 18
+    DISCONNECT_ALL = 19
+    RECONNECT_SESSION = 20
+    TOGGLE_SELECTED = 21
+    UNPAIR_SELECTED = 22
+    TOGGLE_FAVOURITE = 23
+
+
+# Adapter setting -> (action, state when enabled, state when disabled)
+visibility_settings = {'discoverable': (Action.CHANGE_DISCOVERABLE, 'discoverable', 'invisible'),
+                       'pairable': (Action.CHANGE_PAIRABLE, 'pairable', 'not pairable')}
 
 
 def set_input(extension, keyword, last_input, arg=''):
@@ -36,6 +79,71 @@ def set_input(extension, keyword, last_input, arg=''):
     return extension.on_input(keyword, arg) if same_as_before else SetUserQueryAction(f'{keyword} {arg}')
 
 
+def discovery_filter(preferences):
+    rssi = preferences.get('scan_rssi', '').strip()
+    return {'transport': preferences.get('scan_transport', 'auto'),
+            'rssi': int(rssi) if re.fullmatch('-?\\d+', rssi) else None,
+            'duplicate_data': preferences.get('scan_duplicate_data') == 'yes'}
+
+
+def scan_duration(preferences):
+    duration = preferences.get('scan_duration', '').strip()
+    if not duration or duration.isdigit():
+        return int(duration or 0)
+    seconds = parse_time(duration)
+    return DEFAULT_SCAN_DURATION if seconds is None else seconds
+
+
+def duty_cycle(preferences):
+    m = re.fullmatch('(\\d+)\\s*/\\s*(\\d+)', preferences.get('scan_duty_cycle', '').strip())
+    if m is None or not 0 < int(m.group(1)) < int(m.group(2)):
+        return None
+    return int(m.group(1)), int(m.group(2))
+
+
+def scan_status(status):
+    remaining, scanning = status
+    lines = [] if remaining == math.inf else [f'Stops in {time_to_str(math.ceil(remaining))}']
+    if not scanning:
+        lines.append('Paused between scans')
+    return ''.join(f'{line}\n' for line in lines)
+
+
+def set_power(bt_tools, preferences, powered, adapter_path):
+    backend = preferences.get('power_backend', 'bluez')
+    if backend != 'command':
+        # noinspection PyBroadException
+        try:
+            bt_tools.set_powered(powered, adapter_path, rfkill=backend == 'rfkill', timeout=ACTION_TIMEOUT)
+            return
+        except Exception:
+            logger.warning('Could not turn Bluetooth %s directly, running the command instead',
+                           'on' if powered else 'off', exc_info=True)
+    subprocess.call(shlex.split(preferences['command_on' if powered else 'command_off']), stdout=subprocess.DEVNULL)
+    bt_tools.wait_for(lambda: bt_tools.is_powered(adapter_path) == powered, ACTION_TIMEOUT)
+
+
+def scan_limit(preferences):
+    limit = preferences.get('scan_limit', '').strip()
+    return int(limit) if limit.isdigit() and int(limit) > 0 else DEFAULT_SCAN_LIMIT
+
+
+def connect_profile(preferences):
+    return profiles.get(preferences.get('connect_profile', 'any'))
+
+
+def bulk_parallelism(preferences):
+    parallelism = preferences.get('bulk_parallelism', '').strip()
+    return int(parallelism) if parallelism.isdigit() and int(parallelism) > 0 else DEFAULT_BULK_PARALLELISM
+
+
+def connecting_item():
+    return ExtensionResultItem(icon='images/icon.png',
+                               name='Connecting to Bluetooth...',
+                               highlightable=False,
+                               on_enter=DoNothingAction())
+
+
 def go_back_item(keyword, name='Go back', new_input=''):
     return ExtensionResultItem(icon='images/back.png',
                                name=name,
@@ -43,22 +151,17 @@ def go_back_item(keyword, name='Go back', new_input=''):
                                on_enter=SetUserQueryAction(f'{keyword} {new_input}'))
 
 
+time_pattern = re.compile('(\\d+)([dhms])')
+time_units = {'d': 24 * 60 * 60, 'h': 60 * 60, 'm': 60, 's': 1}
+
+
 def parse_time(time_str):
     seconds = 0
-    r = re.compile('(\\d+)([dhms])')
     for arg in time_str.split(' '):
-        m = r.match(arg)
+        m = time_pattern.match(arg)
         if not m:
             return None
-        number, unit = int(m.group(1)), m.group(2)
-        if unit == 'd':
-            seconds += number * 24 * 60 * 60
-        elif unit == 'h':
-            seconds += number * 60 * 60
-        elif unit == 'm':
-            seconds += number * 60
-        else:
-            seconds += number
+        seconds += int(m.group(1)) * time_units[m.group(2)]
     return seconds
 
 
@@ -82,515 +185,944 @@ def time_to_str(seconds):
     return ' '.join(arr)
 
 
+def load_icon_table():
+    table = {}
+    for file in images_path.glob('*_[0-2].png'):
+        icon, icon_type = file.stem.rsplit('_', 1)
+        table[(icon, icon_type)] = f'images/{file.name}'
+    return table
+
+
+icon_table = load_icon_table()
+default_icons = {icon_type: icon_table[('default', icon_type)] for icon_type in ('0', '1', '2')}
+icon_classes = {}
+
+
 def get_icon(device):
-    is_dict = isinstance(device, dict)
-    if is_dict and 'Icon' not in device:
-        return f'images/default_0.png'
-
-    icon_str = device['Icon'] if is_dict else device.Icon
-    paired = device['Paired'] if is_dict else device.Paired
-    connected = device['Connected'] if is_dict else device.Connected
-
-    icon = icon_str.split('-', 2)[0]
-    icon_type = '2' if connected else '1' if paired else '0'
-    file_name = f'{icon}_{icon_type}.png'
-    if (images_path / file_name).is_file():
-        return f'images/{file_name}'
+    if 'Icon' not in device:
+        return default_icons['0']
+
+    icon_str = device['Icon']
+    icon = icon_classes.get(icon_str)
+    if icon is None:
+        icon = icon_classes[icon_str] = icon_str.split('-', 2)[0]
+    icon_type = '2' if device['Connected'] else '1' if device['Paired'] else '0'
+    return icon_table.get((icon, icon_type)) or default_icons[icon_type]
+
+
+def device_status(snapshot, address):
+    status = []
+    if address in snapshot.battery:
+        status.append(f'Battery: {snapshot.battery[address]}%')
+    if address in snapshot.media:
+        profile, streaming = snapshot.media[address]
+        status.append(f'Audio: {profile}{" (streaming)" if streaming else ""}')
+    return status
+
+
+def device_route(address, from_paired):
+    return f'device{"_p" if from_paired else ""} {address}'
+
+
+def device_item(query, device, from_paired):
+    address = device['Address']
+    if not device['Paired']:
+        return ExtensionResultItem(icon=get_icon(device),
+                                   name=device['Alias'],
+                                   description='Enter to pair',
+                                   highlightable=False,
+                                   on_enter=query.action(Action.PAIR, device=address, from_paired=False))
+
+    connected = device['Connected']
+    manage = query.set_query(device_route(address, from_paired))
+    return ExtensionResultItem(
+        icon=get_icon(device),
+        name=device['Alias'],
+        description='Connected\nEnter to manage' if connected else 'Enter to connect\nAlt+Enter to manage',
+        highlightable=False,
+        on_enter=manage if connected else query.action(Action.CONNECT, device=address, from_paired=from_paired),
+        on_alt_enter=manage
+    )
+
+
+def alias_items(query, icon, action, cancel_input, alias=None, description='', **data):
+    if alias is None:
+        item = ExtensionResultItem(icon=icon,
+                                   name='Enter new alias...',
+                                   description=description,
+                                   highlightable=False,
+                                   on_enter=DoNothingAction())
     else:
-        return f'images/default_{icon_type}.png'
+        item = ExtensionResultItem(icon=icon,
+                                   name=f'Set the new alias: {alias}',
+                                   description=description,
+                                   highlightable=False,
+                                   on_enter=query.action(action, alias=alias, **data))
+    return [item, go_back_item(query.keyword, name='Cancel', new_input=cancel_input)]
+
+
+class BulkOperation:
+
+    def __init__(self, title, devices, running, done):
+        self.title = title
+        # Status descriptions while the operation runs for a device and after it succeeded.
+        self.running, self.done = running, done
+        # Address -> [device properties, state, error], state is one of 'waiting', 'running', 'done' and 'failed'.
+        self.devices = OrderedDict((device['Address'], [device, 'waiting', None]) for device in devices)
+        self.started, self.finished = time.monotonic(), None
+
+    def count(self, state):
+        return sum(1 for _, s, _ in self.devices.values() if s == state)
+
+
+class Query:
+
+    def __init__(self, keyword, arg, snapshot, cached=False):
+        self.keyword, self.arg = keyword, arg
+        self.snapshot = snapshot
+        # Whether the snapshot comes from the device cache because BlueZ is not connected yet.
+        self.cached = cached
+        self.adapter, self.adapter_path = snapshot.adapter, snapshot.adapter_path
+
+    def action(self, action, **data):
+        return ExtensionCustomAction({'keyword': self.keyword,
+                                      'last_input': self.arg,
+                                      'adapter': self.adapter_path,
+                                      'action': action,
+                                      **data}, keep_app_open=True)
+
+    def set_query(self, new_input):
+        return SetUserQueryAction(f'{self.keyword} {new_input}')
 
 
 class BluetoothExtension(Extension):
 
-    def __init__(self):
+    def __init__(self, bus=None):
+        start = time.perf_counter()
         super().__init__()
-        self.bt_tools = BtTools()
+        # BtTools connects to the system bus and loads all objects, so it is created in the background and the
+        # extension can answer its first query right away.
+        self._bus = bus
+        self._bt_tools, self._bt_error, self._bt_connecting = None, None, False
+        self._bt_ready = threading.Event()
+        self.settings = Settings()
+        self.frecency = Frecency(self.settings)
+        self.device_cache = DeviceCache()
+        self.auto_reconnect = None
+        self.scanner = None
+        self.executor = ThreadPoolExecutor(max_workers=ACTION_WORKERS, thread_name_prefix='bt-action')
+        self.pending = {}
+        self._lock = threading.RLock()
+        # Advances whenever extension state that is rendered besides the Bluetooth state changes.
+        self.generation = 0
+        self._renders = OrderedDict()
+        self._current_event, self._current_render, self._streaming = None, None, False
+        self._refresh_timer, self._last_refresh = None, 0
+        self.bulk = None
+        self.selected = set()
+        # (adapter path, addresses) of the devices that were connected before the last "disconnect all" or turning off.
+        self.last_session = None, []
+        self.router = self._build_router()
         self.subscribe(KeywordQueryEvent, KeywordQueryEventListener())
         self.subscribe(ItemEnterEvent, ItemEnterEventListener())
+        self.subscribe(PreferencesEvent, PreferencesUpdateEventListener())
+        self.subscribe(PreferencesUpdateEvent, PreferencesUpdateEventListener())
+        self.connect_bluetooth()
+        stats.add('startup extension', (time.perf_counter() - start) * 1000)
+
+    @property
+    def bt_tools(self):
+        self._bt_ready.wait()
+        return self._bt_tools
+
+    def wait_for_bluetooth(self, timeout=None):
+        return self._bt_ready.wait(timeout) and self._bt_tools is not None
+
+    def connect_bluetooth(self):
+        with self._lock:
+            if self._bt_connecting or self._bt_tools is not None:
+                return
+            self._bt_connecting = True
+            self._bt_ready.clear()
+        threading.Thread(target=self._connect_bluetooth, name='bt-connect', daemon=True).start()
+
+    def _connect_bluetooth(self):
+        start = time.perf_counter()
+        # noinspection PyBroadException
+        try:
+            bt_tools, error = BtTools(self._bus), None
+            bt_tools.add_listener(self._on_state_changed)
+            self.auto_reconnect = AutoReconnect(bt_tools, self.favourites)
+            self.scanner = ScanManager(bt_tools, self._on_scan_changed)
+            self.device_cache.attach(bt_tools)
+            logger.info('Connected to BlueZ in %.0f ms', (time.perf_counter() - start) * 1000)
+        except Exception as e:
+            logger.exception('Could not connect to BlueZ')
+            bt_tools, error = None, str(e)
+        stats.add('startup bluetooth', (time.perf_counter() - start) * 1000)
+        with self._lock:
+            self._bt_tools, self._bt_error, self._bt_connecting = bt_tools, error, False
+            self._bt_ready.set()
+            self.invalidate()
+        self.refresh()
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+
+    def apply_preferences(self):
+        stats.configure(log_file=self.preferences.get('stats_log', '').strip(),
+                        profile_dir=self.preferences.get('profile_dir', '').strip())
+        self.invalidate()
+
+    def set_current(self, event, render, streaming=False):
+        with self._lock:
+            self._current_event, self._current_render, self._streaming = event, render, streaming
+        if self.scanner is not None:
+            self.scanner.set_watching(streaming)
+
+    def _on_scan_changed(self):
+        self.invalidate()
+        self.refresh()
+
+    def scan_status(self, adapter_path):
+        return None if self.scanner is None else self.scanner.status(adapter_path)
+
+    def _on_state_changed(self, path, iface, changed):
+        if self._streaming and iface in (DEVICE_IFACE, ADAPTER_IFACE, None):
+            self.schedule_refresh()
+
+    def schedule_refresh(self):
+        with self._lock:
+            if self._refresh_timer is not None:
+                return
+            delay = max(0, self._last_refresh + STREAM_REFRESH_INTERVAL - time.monotonic())
+            self._refresh_timer = threading.Timer(delay, self._scheduled_refresh)
+            self._refresh_timer.daemon = True
+            self._refresh_timer.start()
+
+    def _scheduled_refresh(self):
+        with self._lock:
+            self._refresh_timer, self._last_refresh = None, time.monotonic()
+        self.refresh()
+
+    def refresh(self):
+        with self._lock:
+            event, render = self._current_event, self._current_render
+        if render is not None:
+            result = render()
+            if result is not None:
+                self._client.send(Response(event, result))
+
+    def pending_items(self):
+        with self._lock:
+            descriptions = list(self.pending.values())
+        return [ExtensionResultItem(icon='images/icon.png',
+                                    name=description,
+                                    description='Waiting for the result...',
+                                    highlightable=False,
+                                    on_enter=DoNothingAction()) for description in descriptions]
+
+    def render_pending(self, keyword, last_input):
+        return RenderResultListAction(self.pending_items() + [go_back_item(keyword, new_input=last_input)])
+
+    def run_action(self, event, keyword, last_input, key, description, action, failed_arg=None):
+        if failed_arg is None:
+            failed_arg = last_input
+
+        with self._lock:
+            if key not in self.pending:
+                self.pending[key] = description
+                self.invalidate()
+
+                def run():
+                    # noinspection PyBroadException
+                    try:
+                        with stats.span(f'action {action.__name__}'):
+                            arg = action()
+                    except Exception:
+                        arg = failed_arg
+                    with self._lock:
+                        self.pending.pop(key, None)
+                        self.invalidate()
+                        is_current = self._current_event is event
+                        if is_current:
+                            self.set_current(event, lambda: self.on_input(keyword, arg))
+                    if is_current:
+                        self._client.send(Response(event, set_input(self, keyword, last_input, arg=arg)))
+                    else:
+                        self.refresh()
+
+                self.executor.submit(run)
+
+        self.set_current(event, lambda: self.render_pending(keyword, last_input))
+        return self.render_pending(keyword, last_input)
+
+    def run_bulk(self, title, devices, operation, running, done):
+        if not devices:
+            return
+        bulk = BulkOperation(title, devices, running, done)
+        with self._lock:
+            if self.bulk is not None and self.bulk.finished is None:
+                return
+            self.bulk = bulk
+            self.invalidate()
+
+        def set_state(address, state, error=None):
+            with self._lock:
+                bulk.devices[address][1:] = state, error
+                self.invalidate()
+            self.refresh()
+
+        def run_one(address):
+            set_state(address, 'running')
+            # noinspection PyBroadException
+            try:
+                operation(address)
+            except Exception as e:
+                set_state(address, 'failed', str(e))
+            else:
+                set_state(address, 'done')
+
+        def run_all():
+            with stats.span(f'bulk {title}'):
+                with ThreadPoolExecutor(max_workers=bulk_parallelism(self.preferences),
+                                        thread_name_prefix='bt-bulk') as pool:
+                    for address in bulk.devices:
+                        pool.submit(run_one, address)
+            with self._lock:
+                bulk.finished = time.monotonic()
+                self.invalidate()
+            self.refresh()
+
+        self.executor.submit(run_all)
+
+    def favourites(self):
+        return set(self.settings.get('favourites', []))
+
+    def toggle_favourite(self, address):
+        with self._lock:
+            self.settings.set('favourites', sorted(self.favourites() ^ {address}))
+            self.invalidate()
+
+    def remember_session(self, snapshot):
+        if snapshot.connected:
+            self.last_session = snapshot.adapter_path, list(snapshot.connected)
+
+    def search_devices(self, snapshot, query):
+        return [snapshot.by_path[path] for path in self.bt_tools.search(query, snapshot.adapter_path)
+                if path in snapshot.by_path]
 
     def on_input(self, keyword, arg):
-        adapter = self.bt_tools.get_adapter()
-        if adapter is None:
+        if not self.wait_for_bluetooth(0):
+            return self.render_cached(keyword, arg) or self.render_unavailable(keyword, arg)
+        # The statistics and the time left of a scan change without any Bluetooth state changing.
+        if (arg or '').startswith('stats') or self.scanner.active():
+            return self.render(keyword, arg)
+
+        key = (keyword, arg or '', self.bt_tools.generation, self.generation)
+        with self._lock:
+            result = self._renders.get(key)
+            if result is not None:
+                self._renders.move_to_end(key)
+                stats.add('query memoized', 0)
+                return result
+
+        result = self.render(keyword, arg)
+        if result is not None:
+            with self._lock:
+                self._renders[key] = result
+                if len(self._renders) > RENDER_CACHE_SIZE:
+                    self._renders.popitem(last=False)
+        return result
+
+    def _build_router(self):
+        router = Router({'address': Converter(normalize_address),
+                         'text': Converter(str, greedy=True),
+                         'duration': Converter(parse_time, greedy=True)})
+        router.add('', self.render_home)
+        router.add('settings', self.render_settings)
+        router.add('settings alias {alias:text}', self.render_adapter_alias)
+        for setting in visibility_settings:
+            router.add(f'settings {setting} {{timeout:duration}}', self.render_visibility_timeout, setting=setting)
+        router.add('adapters', self.render_adapters)
+        router.add('paired {search:text}', self.render_paired)
+        router.add('scanned', self.render_scanned)
+        router.add('stats', self.render_stats)
+        router.add('bulk', self.render_bulk)
+        router.add('unpair', self.render_unpair_selection)
+        for route, from_paired in (('device', False), ('device_p', True)):
+            router.add(f'{route} {{address:address}}', self.render_device, from_paired=from_paired)
+            router.add(f'{route} {{address:address}} alias {{alias:text}}', self.render_device_alias,
+                       from_paired=from_paired)
+        router.set_fallback(self.render_search)
+        return router
+
+    def render_cached(self, keyword, arg):
+        if self._bt_ready.is_set():
+            return None
+        handler, kwargs = self.router.resolve(arg)
+        if handler not in (self.render_home, self.render_paired) or kwargs:
+            return None
+        snapshot = self.device_cache.snapshot()
+        if snapshot is None or snapshot.adapter is None or not snapshot.adapter.get('Powered', True):
+            return None
+        with stats.span('screen cached'):
+            return handler(Query(keyword, arg, snapshot, cached=True))
+
+    def render_unavailable(self, keyword, arg):
+        if not self._bt_ready.is_set():
+            item = connecting_item()
+        else:
+            item = ExtensionResultItem(icon='images/icon.png',
+                                       name='Bluetooth service is not available',
+                                       description=f'{self._bt_error}\nEnter to retry',
+                                       highlightable=False,
+                                       on_enter=ExtensionCustomAction({'keyword': keyword,
+                                                                       'last_input': arg,
+                                                                       'action': Action.RELOAD}, keep_app_open=True))
+        return RenderResultListAction([item])
+
+    def render(self, keyword, arg):
+        query = Query(keyword, arg, self.bt_tools.snapshot(nearby_limit=scan_limit(self.preferences)))
+        if query.adapter is None or not query.adapter.get('Powered', True):
             return RenderResultListAction([
                 ExtensionResultItem(icon='images/icon.png',
                                     name='Turn Bluetooth on',
                                     highlightable=False,
-                                    on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                                    'last_input': arg,
-                                                                    'action': Action.TURN_ON}, keep_app_open=True))
+                                    on_enter=query.action(Action.TURN_ON))
             ])
 
-        if not arg:
-            items = []
-
-            for address, device in self.bt_tools.get_connected_devices().items():
-                items.append(ExtensionResultItem(
-                    icon=get_icon(device),
-                    name=f'Connected: {device["Alias"]}',
-                    description='Enter to manage'
-                                '\nAlt+Enter to disconnect',
-                    highlightable=False,
-                    on_enter=SetUserQueryAction(f'{keyword} device {device["Address"]}'),
-                    on_alt_enter=ExtensionCustomAction({'keyword': keyword,
-                                                        'last_input': arg,
-                                                        'action': Action.DISCONNECT,
-                                                        'device': address,
-                                                        'from_paired': False}, keep_app_open=True)
-                ))
+        handler, kwargs = self.router.resolve(arg)
+        screen = handler.__name__[len('render_'):]
+        with stats.span(f'screen {screen}'), stats.profile(screen):
+            return handler(query, **kwargs)
+
+    def render_home(self, query):
+        snapshot, adapter = query.snapshot, query.adapter
+        items = self.pending_items()
+        if query.cached:
+            items.insert(0, connecting_item())
+
+        with self._lock:
+            bulk = self.bulk if self.bulk is not None and self.bulk.finished is None else None
+            if bulk is not None:
+                items.append(ExtensionResultItem(icon='images/icon.png',
+                                                 name=f'{bulk.title}: {bulk.count("done")}/{len(bulk.devices)} done',
+                                                 description='Enter to show the progress',
+                                                 highlightable=False,
+                                                 on_enter=query.set_query('bulk')))
+
+        for device in self.frecency.sort(snapshot.connected.values()):
+            address = device['Address']
+            status = ', '.join(device_status(snapshot, address))
+            items.append(ExtensionResultItem(
+                icon=get_icon(device),
+                name=f'Connected: {device["Alias"]}',
+                description=(f'{status}\n' if status else '')
+                            + 'Enter to manage'
+                            '\nAlt+Enter to disconnect',
+                highlightable=False,
+                on_enter=query.set_query(device_route(address, False)),
+                on_alt_enter=query.action(Action.DISCONNECT, device=address, from_paired=False)
+            ))
 
-            items.extend([
-                ExtensionResultItem(icon='images/icon.png',
-                                    name='Change adapter settings',
-                                    description='Edit alias and manage discovery and pairing mode',
-                                    highlightable=False,
-                                    on_enter=SetUserQueryAction(f'{keyword} settings')),
-                ExtensionResultItem(icon='images/icon.png',
-                                    name='Paired devices',
-                                    description=f'There are {len(self.bt_tools.get_paired_devices())} paired devices',
-                                    highlightable=False,
-                                    on_enter=SetUserQueryAction(f'{keyword} paired'))
-            ])
+        if len(snapshot.connected) > 1:
+            items.append(ExtensionResultItem(icon='images/icon.png',
+                                             name=f'Disconnect all {len(snapshot.connected)} devices',
+                                             highlightable=False,
+                                             on_enter=query.action(Action.DISCONNECT_ALL)))
+
+        session_path, session = self.last_session
+        reconnect = [address for address in session if address in snapshot.paired and address not in snapshot.connected]
+        if session_path == query.adapter_path and reconnect:
+            items.append(ExtensionResultItem(icon='images/icon.png',
+                                             name=f'Reconnect last session ({len(reconnect)} devices)',
+                                             description=', '.join(snapshot.paired[a]['Alias'] for a in reconnect),
+                                             highlightable=False,
+                                             on_enter=query.action(Action.RECONNECT_SESSION)))
+
+        if len(snapshot.adapters) > 1:
+            items.append(ExtensionResultItem(icon='images/icon.png',
+                                             name=f'Adapter: {adapter["Alias"]} ({adapter_name(query.adapter_path)})',
+                                             description=f'There are {len(snapshot.adapters)} adapters'
+                                                         '\nEnter to select another one',
+                                             highlightable=False,
+                                             on_enter=query.set_query('adapters')))
+
+        items.extend([
+            ExtensionResultItem(icon='images/icon.png',
+                                name='Change adapter settings',
+                                description='Edit alias and manage discovery and pairing mode',
+                                highlightable=False,
+                                on_enter=query.set_query('settings')),
+            ExtensionResultItem(icon='images/icon.png',
+                                name='Paired devices',
+                                description=f'There are {len(snapshot.paired)} paired devices',
+                                highlightable=False,
+                                on_enter=query.set_query('paired'))
+        ])
+
+        status = self.scan_status(query.adapter_path)
+        if adapter['Discovering'] or status is not None:
+            items.append(ExtensionResultItem(
+                icon='images/icon.png',
+                name=f'Devices found while scanning: {len(snapshot.nearby)}',
+                description=f'{scan_status(status) if status else ""}Enter to list devices'
+                            '\nAlt+Enter to stop scanning',
+                highlightable=False,
+                on_enter=query.set_query('scanned'),
+                on_alt_enter=query.action(Action.STOP_SCAN)
+            ))
+        else:
+            items.append(ExtensionResultItem(
+                icon='images/icon.png',
+                name='Start scanning for devices',
+                highlightable=False,
+                on_enter=query.action(Action.START_SCAN)
+            ))
 
-            if adapter.Discovering:
+        items.append(ExtensionResultItem(
+            icon='images/icon.png',
+            name='Turn Bluetooth off',
+            highlightable=False,
+            on_enter=query.action(Action.TURN_OFF)
+        ))
+        return RenderResultListAction(items)
+
+    def render_settings(self, query):
+        adapter = query.adapter
+        items = [
+            go_back_item(query.keyword),
+            ExtensionResultItem(icon='images/icon.png',
+                                name='Reload settings',
+                                highlightable=False,
+                                on_enter=query.action(Action.RELOAD)),
+            ExtensionResultItem(icon='images/icon.png',
+                                name=f'Alias: "{adapter["Alias"]}"',
+                                description='Enter to change',
+                                highlightable=False,
+                                on_enter=query.set_query('settings alias '))
+        ]
+
+        for setting, (action, on, off) in visibility_settings.items():
+            prop = setting.capitalize()
+            if adapter[prop]:
+                temporary = adapter[f'{prop}Timeout'] != 0
                 items.append(ExtensionResultItem(
                     icon='images/icon.png',
-                    name=f'Devices found while scanning: {len(self.bt_tools.get_nearby_devices())}',
-                    description='Enter to list devices'
-                                '\nAlt+Enter to stop scanning',
+                    name=f'Adapter is {"temporarily " if temporary else ""}{on}',
+                    description=f'Enter to make it {off}'
+                                f'\nAlt+Enter to make it {"permanentely" if temporary else "temporarily"} {on}',
                     highlightable=False,
-                    on_enter=SetUserQueryAction(f'{keyword} scanned'),
-                    on_alt_enter=ExtensionCustomAction({'keyword': keyword,
-                                                        'last_input': arg,
-                                                        'action': Action.STOP_SCAN}, keep_app_open=True)
+                    on_enter=query.action(action, **{setting: False}),
+                    on_alt_enter=query.action(action, **{setting: True}) if temporary
+                    else query.set_query(f'settings {setting} ')
                 ))
             else:
                 items.append(ExtensionResultItem(
                     icon='images/icon.png',
-                    name='Start scanning for devices',
+                    name=f'Adapter is {off}',
+                    description=f'Enter to make it {on}'
+                                f'\nAlt+Enter to make it temporarily {on}',
                     highlightable=False,
-                    on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                    'last_input': arg,
-                                                    'action': Action.START_SCAN}, keep_app_open=True)
+                    on_enter=query.action(action, **{setting: True}),
+                    on_alt_enter=query.set_query(f'settings {setting} ')
                 ))
 
+        return RenderResultListAction(items)
+
+    def render_adapter_alias(self, query, alias=None):
+        return RenderResultListAction(alias_items(query, 'images/icon.png', Action.CHANGE_ADAPTER_ALIAS, 'settings',
+                                                  alias))
+
+    def render_visibility_timeout(self, query, setting, **kwargs):
+        action = visibility_settings[setting][0]
+        help_text = 'You can use "s", "m", "h" and "d"\nFor example: "1h 30m"'
+        seconds = kwargs.get('timeout')
+        if 'timeout' not in kwargs:
+            item = ExtensionResultItem(icon='images/icon.png',
+                                       name=f'Enter the new {setting} timeout',
+                                       description=help_text,
+                                       highlightable=False,
+                                       on_enter=DoNothingAction())
+        elif seconds is None:
+            item = ExtensionResultItem(icon='images/icon.png',
+                                       name='Invalid time format',
+                                       description=help_text,
+                                       highlightable=False,
+                                       on_enter=DoNothingAction())
+        elif seconds <= 0:
+            item = ExtensionResultItem(icon='images/icon.png',
+                                       name='Invalid time (has to be at least 1 second)',
+                                       description=help_text,
+                                       highlightable=False,
+                                       on_enter=DoNothingAction())
+        else:
+            item = ExtensionResultItem(icon='images/icon.png',
+                                       name=f'Set the new {setting} timeout: {time_to_str(seconds)}',
+                                       description=help_text,
+                                       highlightable=False,
+                                       on_enter=query.action(action, **{setting: True, 'timeout': seconds}))
+
+        return RenderResultListAction([item, go_back_item(query.keyword, name='Cancel', new_input='settings')])
+
+    def render_adapters(self, query):
+        items = [go_back_item(query.keyword)]
+        for path in sorted(query.snapshot.adapters, key=lambda p: (len(p), p)):
+            properties = query.snapshot.adapters[path]
+            selected = path == query.adapter_path
             items.append(ExtensionResultItem(
                 icon='images/icon.png',
-                name='Turn Bluetooth off',
+                name=f'{properties["Alias"]} ({adapter_name(path)})' + (' (Selected)' if selected else ''),
+                description=f'Address: {properties["Address"]}' + ('' if selected else '\nEnter to select'),
                 highlightable=False,
-                on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                'last_input': arg,
-                                                'action': Action.TURN_OFF}, keep_app_open=True)
+                on_enter=DoNothingAction() if selected else query.action(Action.SELECT_ADAPTER, adapter=path)
             ))
-            return RenderResultListAction(items)
 
-        args = arg.split(' ')
-        if args[0] == 'settings':
-            if len(args) == 1:
-                items = [
-                    go_back_item(keyword),
-                    ExtensionResultItem(icon='images/icon.png',
-                                        name='Reload settings',
-                                        highlightable=False,
-                                        on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                                        'last_input': arg,
-                                                                        'action': Action.RELOAD}, keep_app_open=True)),
-                    ExtensionResultItem(icon='images/icon.png',
-                                        name=f'Alias: "{adapter.Alias}"',
-                                        description='Enter to change',
-                                        highlightable=False,
-                                        on_enter=SetUserQueryAction(f'{keyword} settings alias '))
-                ]
-
-                if adapter.Discoverable:
-                    if adapter.DiscoverableTimeout == 0:
-                        items.append(ExtensionResultItem(
-                            icon='images/icon.png',
-                            name='Adapter is discoverable',
-                            description='Enter to make it invisible'
-                                        '\nAlt+Enter to make it temporarily discoverable',
-                            highlightable=False,
-                            on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                            'last_input': arg,
-                                                            'action': Action.CHANGE_DISCOVERABLE,
-                                                            'discoverable': False}, keep_app_open=True),
-                            on_alt_enter=SetUserQueryAction(f'{keyword} settings discoverable ')
-                        ))
-                    else:
-                        items.append(ExtensionResultItem(
-                            icon='images/icon.png',
-                            name='Adapter is temporarily discoverable',
-                            description='Enter to make it invisible'
-                                        '\nAlt+Enter to make it permanentely discoverable',
-                            highlightable=False,
-                            on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                            'last_input': arg,
-                                                            'action': Action.CHANGE_DISCOVERABLE,
-                                                            'discoverable': False}, keep_app_open=True),
-                            on_alt_enter=ExtensionCustomAction({'keyword': keyword,
-                                                                'last_input': arg,
-                                                                'action': Action.CHANGE_DISCOVERABLE,
-                                                                'discoverable': True}, keep_app_open=True)
-                        ))
-                else:
-                    items.append(ExtensionResultItem(
-                        icon='images/icon.png',
-                        name='Adapter is invisible',
-                        description='Enter to make it discoverable'
-                                    '\nAlt+Enter to make it temporarily discoverable',
-                        highlightable=False,
-                        on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                        'last_input': arg,
-                                                        'action': Action.CHANGE_DISCOVERABLE,
-                                                        'discoverable': True}, keep_app_open=True),
-                        on_alt_enter=SetUserQueryAction(f'{keyword} settings discoverable ')
-                    ))
-
-                if adapter.Pairable:
-                    if adapter.PairableTimeout == 0:
-                        items.append(ExtensionResultItem(
-                            icon='images/icon.png',
-                            name='Adapter is pairable',
-                            description='Enter to make it not pairable'
-                                        '\nAlt+Enter to make it temporarily pairable',
-                            highlightable=False,
-                            on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                            'last_input': arg,
-                                                            'action': Action.CHANGE_PAIRABLE,
-                                                            'pairable': False}, keep_app_open=True),
-                            on_alt_enter=SetUserQueryAction(f'{keyword} settings pairable ')
-                        ))
-                    else:
-                        items.append(ExtensionResultItem(
-                            icon='images/icon.png',
-                            name='Adapter is temporarily pairable',
-                            description='Enter to make it not pairable'
-                                        '\nAlt+Enter to make it permanentely pairable',
-                            highlightable=False,
-                            on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                            'last_input': arg,
-                                                            'action': Action.CHANGE_PAIRABLE,
-                                                            'pairable': False}, keep_app_open=True),
-                            on_alt_enter=ExtensionCustomAction({'keyword': keyword,
-                                                                'last_input': arg,
-                                                                'action': Action.CHANGE_PAIRABLE,
-                                                                'pairable': True}, keep_app_open=True)
-                        ))
-                else:
-                    items.append(ExtensionResultItem(
-                        icon='images/icon.png',
-                        name='Adapter is not pairable',
-                        description='Enter to make it pairable'
-                                    '\nAlt+Enter to make it temporarily pairable',
-                        highlightable=False,
-                        on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                        'last_input': arg,
-                                                        'action': Action.CHANGE_PAIRABLE,
-                                                        'pairable': True}, keep_app_open=True),
-                        on_alt_enter=SetUserQueryAction(f'{keyword} settings pairable ')
-                    ))
-
-                return RenderResultListAction(items)
-
-            if args[1] == 'alias':
-                items = []
-                if len(args) == 2:
-                    items.append(ExtensionResultItem(icon='images/icon.png',
-                                                     name='Enter new alias...',
-                                                     highlightable=False,
-                                                     on_enter=DoNothingAction()))
-                else:
-                    alias = ' '.join(args[2:])
-                    items.append(ExtensionResultItem(
-                        icon='images/icon.png',
-                        name=f'Set the new alias: {alias}',
-                        highlightable=False,
-                        on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                        'last_input': arg,
-                                                        'action': Action.CHANGE_ADAPTER_ALIAS,
-                                                        'alias': alias}, keep_app_open=True)
-                    ))
-
-                items.append(go_back_item(keyword, name='Cancel', new_input='settings'))
-                return RenderResultListAction(items)
-
-            if args[1] == 'discoverable':
-                items = []
-                if len(args) == 2:
-                    items.append(ExtensionResultItem(icon='images/icon.png',
-                                                     name='Enter the new discoverable timeout',
-                                                     description='You can use "s", "m", "h" and "d"'
-                                                                 '\nFor example: "1h 30m"',
-                                                     highlightable=False,
-                                                     on_enter=DoNothingAction()))
-                else:
-                    seconds = parse_time(' '.join(args[2:]))
-                    if seconds is None:
-                        items.append(ExtensionResultItem(icon='images/icon.png',
-                                                         name='Invalid time format',
-                                                         description='You can use "s", "m", "h" and "d"'
-                                                                     '\nFor example: "1h 30m"',
-                                                         highlightable=False,
-                                                         on_enter=DoNothingAction()))
-                    elif seconds <= 0:
-                        items.append(ExtensionResultItem(icon='images/icon.png',
-                                                         name='Invalid time (has to be at least 1 second)',
-                                                         description='You can use "s", "m", "h" and "d"'
-                                                                     '\nFor example: "1h 30m"',
-                                                         highlightable=False,
-                                                         on_enter=DoNothingAction()))
-                    else:
-                        items.append(ExtensionResultItem(
-                            icon='images/icon.png',
-                            name=f'Set the new discoverable timeout: {time_to_str(seconds)}',
-                            description='You can use "s", "m", "h" and "d"'
-                                        '\nFor example: "1h 30m"',
-                            highlightable=False,
-                            on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                            'last_input': arg,
-                                                            'action': Action.CHANGE_DISCOVERABLE,
-                                                            'discoverable': True,
-                                                            'timeout': seconds}, keep_app_open=True)
-                        ))
-
-                items.append(go_back_item(keyword, name='Cancel', new_input='settings'))
-                return RenderResultListAction(items)
-
-            if args[1] == 'pairable':
-                items = []
-                if len(args) == 2:
-                    items.append(ExtensionResultItem(icon='images/icon.png',
-                                                     name='Enter the new pairable timeout',
-                                                     description='You can use "s", "m", "h" and "d"'
-                                                                 '\nFor example: "1h 30m"',
-                                                     highlightable=False,
-                                                     on_enter=DoNothingAction()))
-                else:
-                    seconds = parse_time(' '.join(args[2:]))
-                    if seconds is None:
-                        items.append(ExtensionResultItem(icon='images/icon.png',
-                                                         name='Invalid time format',
-                                                         description='You can use "s", "m", "h" and "d"'
-                                                                     '\nFor example: "1h 30m"',
-                                                         highlightable=False,
-                                                         on_enter=DoNothingAction()))
-                    elif seconds <= 0:
-                        items.append(ExtensionResultItem(icon='images/icon.png',
-                                                         name='Invalid time (has to be at least 1 second)',
-                                                         description='You can use "s", "m", "h" and "d"'
-                                                                     '\nFor example: "1h 30m"',
-                                                         highlightable=False,
-                                                         on_enter=DoNothingAction()))
-                    else:
-                        items.append(ExtensionResultItem(
-                            icon='images/icon.png',
-                            name=f'Set the new pairable timeout: {time_to_str(seconds)}',
-                            description='You can use "s", "m", "h" and "d"'
-                                        '\nFor example: "1h 30m"',
-                            highlightable=False,
-                            on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                            'last_input': arg,
-                                                            'action': Action.CHANGE_PAIRABLE,
-                                                            'pairable': True,
-                                                            'timeout': seconds}, keep_app_open=True)
-                        ))
-
-                items.append(go_back_item(keyword, name='Cancel', new_input='settings'))
-                return RenderResultListAction(items)
-
-        if args[0] == 'paired':
-            items = [go_back_item(keyword)]
-            for address, device in self.bt_tools.get_paired_devices().items():
-                connected = device['Connected']
-                manage = SetUserQueryAction(f'{keyword} device_p {device["Address"]}')
-                items.append(ExtensionResultItem(
-                    icon=get_icon(device),
-                    name=device['Alias'],
-                    description='Connected\nEnter to manage' if connected else 'Enter to connect\nAlt+Enter to manage',
-                    highlightable=False,
-                    on_enter=manage if connected else ExtensionCustomAction({'keyword': keyword,
-                                                                             'last_input': arg,
-                                                                             'action': Action.CONNECT,
-                                                                             'device': address,
-                                                                             'from_paired': True}, keep_app_open=True),
-                    on_alt_enter=manage
-                ))
-
-            return RenderResultListAction(items)
-
-        if args[0] == 'scanned':
-            items = [
-                go_back_item(keyword),
-                ExtensionResultItem(icon='images/icon.png',
-                                    name='Reload scanned devices',
-                                    highlightable=False,
-                                    on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                                    'last_input': arg,
-                                                                    'action': Action.RELOAD}, keep_app_open=True))
-            ]
-
-            def compare(tuple1, tuple2):
-                _, device1 = tuple1
-                _, device2 = tuple2
-                name1, name2 = 'Name' in device1, 'Name' in device2
-                if name1 and not name2:
-                    return -1
-                if not name1 and name2:
-                    return 1
-                return 0
-
-            for address, device in sorted(list(self.bt_tools.get_nearby_devices().items()), key=cmp_to_key(compare)):
-                paired = device['Paired']
-                items.append(ExtensionResultItem(
-                    icon=get_icon(device),
-                    name=device['Alias'] + (' (Paired)' if paired else ''),
-                    description='Enter to connect'
-                                '\nAlt+Enter to manage' if paired else 'Enter to pair',
-                    highlightable=False,
-                    on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                    'last_input': arg,
-                                                    'action': Action.CONNECT if paired else Action.PAIR,
-                                                    'device': address,
-                                                    'from_paired': False}, keep_app_open=True),
-                    on_alt_enter=SetUserQueryAction(f'{keyword} device {device["Address"]}')
-                    if paired else DoNothingAction()
-                ))
+        return RenderResultListAction(items)
 
+    def render_paired(self, query, search=None):
+        if search is not None:
+            devices = [device for device in self.search_devices(query.snapshot, search) if device['Paired']]
+        else:
+            devices = self.frecency.sort(query.snapshot.paired.values())
+        items = [go_back_item(query.keyword)] + ([connecting_item()] if query.cached else [])
+        if search is None:
+            trusted = [d for d in devices if d['Trusted'] and not d['Connected'] and not d['Blocked']]
+            if trusted:
+                items.append(ExtensionResultItem(icon='images/icon.png',
+                                                 name=f'Connect all trusted devices ({len(trusted)})',
+                                                 description=', '.join(d['Alias'] for d in trusted),
+                                                 highlightable=False,
+                                                 on_enter=query.action(Action.CONNECT_TRUSTED)))
+            if len(query.snapshot.paired) > 1:
+                items.append(ExtensionResultItem(icon='images/icon.png',
+                                                 name='Unpair several devices',
+                                                 highlightable=False,
+                                                 on_enter=query.set_query('unpair')))
+        return RenderResultListAction(items + [device_item(query, device, from_paired=True) for device in devices])
+
+    def render_unpair_selection(self, query):
+        paired = query.snapshot.paired
+        with self._lock:
+            selected = [address for address in self.selected if address in paired]
+        items = [go_back_item(query.keyword, new_input='paired')]
+        if selected:
+            items.append(ExtensionResultItem(icon='images/icon.png',
+                                             name=f'Unpair selected devices ({len(selected)})',
+                                             description=', '.join(paired[address]['Alias'] for address in selected),
+                                             highlightable=False,
+                                             on_enter=query.action(Action.UNPAIR_SELECTED)))
+        for address, device in paired.items():
+            is_selected = address in selected
+            items.append(ExtensionResultItem(icon=get_icon(device),
+                                             name=f'{"[x]" if is_selected else "[ ]"} {device["Alias"]}',
+                                             description=f'Enter to {"de" if is_selected else ""}select',
+                                             highlightable=False,
+                                             on_enter=query.action(Action.TOGGLE_SELECTED, device=address)))
+        return RenderResultListAction(items)
+
+    def render_bulk(self, query):
+        items = [go_back_item(query.keyword)]
+        with self._lock:
+            bulk = self.bulk
+            devices = [tuple(entry) for entry in bulk.devices.values()] if bulk is not None else []
+            finished = bulk.finished if bulk is not None else None
+        if bulk is None:
+            items.append(ExtensionResultItem(icon='images/icon.png',
+                                             name='No operation on several devices has run yet',
+                                             highlightable=False,
+                                             on_enter=DoNothingAction()))
             return RenderResultListAction(items)
 
-        if args[0].startswith('device'):
-            if len(args) == 1:
-                return
+        failed = sum(1 for _, state, _ in devices if state == 'failed')
+        done = sum(1 for _, state, _ in devices if state == 'done')
+        items.append(ExtensionResultItem(
+            icon='images/icon.png',
+            name=f'{bulk.title}: {done}/{len(devices)} done' + (f', {failed} failed' if failed else ''),
+            description=f'Finished in {finished - bulk.started:.1f} s' if finished else 'Running...',
+            highlightable=False,
+            on_enter=DoNothingAction()
+        ))
+        states = {'waiting': 'Waiting', 'running': bulk.running, 'done': bulk.done}
+        for device, state, error in devices:
+            items.append(ExtensionResultItem(icon=get_icon(device),
+                                             name=device['Alias'],
+                                             description=f'Failed: {error}' if state == 'failed' else states[state],
+                                             highlightable=False,
+                                             on_enter=DoNothingAction()))
+        return RenderResultListAction(items)
+
+    def render_scanned(self, query):
+        snapshot = query.snapshot
+        items = [go_back_item(query.keyword)]
+        status = self.scan_status(query.adapter_path)
+        if query.adapter['Discovering'] or status is not None:
+            items.append(ExtensionResultItem(icon='images/icon.png',
+                                             name=f'Scanning... {len(snapshot.nearby)} devices found',
+                                             description=f'{scan_status(status) if status else ""}'
+                                                         'The list updates automatically'
+                                                         '\nEnter to stop scanning',
+                                             highlightable=False,
+                                             on_enter=query.action(Action.STOP_SCAN)))
+        else:
+            items.append(ExtensionResultItem(icon='images/icon.png',
+                                             name='Start scanning for devices',
+                                             highlightable=False,
+                                             on_enter=query.action(Action.START_SCAN)))
 
-            address = args[1].replace('_', ':')
-            device = self.bt_tools.get_device(address)
-            if not device:
-                return
+        for device, rssi in snapshot.ranked:
+            address, paired = device['Address'], device['Paired']
+            items.append(ExtensionResultItem(
+                icon=get_icon(device),
+                name=device['Alias'] + (' (Paired)' if paired else ''),
+                description=f'Signal: {rssi:.0f} dBm'
+                            + ('\nEnter to connect\nAlt+Enter to manage' if paired else '\nEnter to pair'),
+                highlightable=False,
+                on_enter=query.action(Action.CONNECT if paired else Action.PAIR, device=address, from_paired=False),
+                on_alt_enter=query.set_query(device_route(address, False)) if paired else DoNothingAction()
+            ))
 
-            from_paired = args[0].endswith('_p')
-            icon = get_icon(device)
-
-            if len(args) == 2:
-                return RenderResultListAction([
-                    go_back_item(keyword, new_input='paired' if from_paired else ''),
-                    ExtensionResultItem(icon='images/icon.png',
-                                        name='Reload information',
-                                        highlightable=False,
-                                        on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                                        'last_input': arg,
-                                                                        'action': Action.RELOAD}, keep_app_open=True)),
-                    ExtensionResultItem(icon=icon,
-                                        name=f'Device: {device.Name}',
-                                        description=f'Address: {address}'
-                                                    f'\nEnter to unpair',
-                                        highlightable=False,
-                                        on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                                        'last_input': arg,
-                                                                        'action': Action.UNPAIR,
-                                                                        'device': address,
-                                                                        'from_paired': from_paired},
-                                                                       keep_app_open=True)),
-                    ExtensionResultItem(icon=icon,
-                                        name=f'Connected: {"yes" if device.Connected else "no"}',
-                                        description=f'Enter to {"dis" if device.Connected else ""}connect',
-                                        highlightable=False,
-                                        on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                                        'last_input': arg,
-                                                                        'action': Action.DISCONNECT if
-                                                                        device.Connected else Action.CONNECT,
-                                                                        'device': address,
-                                                                        'from_paired': from_paired},
-                                                                       keep_app_open=True)),
-                    ExtensionResultItem(icon=icon,
-                                        name=f'Alias: {device.Alias}',
-                                        description='Enter to change',
-                                        highlightable=False,
-                                        on_enter=SetUserQueryAction(f'{keyword} {args[0]} {address} alias ')),
-                    ExtensionResultItem(icon=icon,
-                                        name=f'Trusted: {"yes" if device.Trusted else "no"}',
-                                        description=f'Enter to {"un" if device.Trusted else ""}trust',
-                                        highlightable=False,
-                                        on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                                        'last_input': arg,
-                                                                        'action': Action.CHANGE_DEVICE_TRUSTED,
-                                                                        'device': address,
-                                                                        'from_paired': from_paired,
-                                                                        'trusted': not device.Trusted},
-                                                                       keep_app_open=True)),
-                    ExtensionResultItem(icon=icon,
-                                        name=f'Blocked: {"yes" if device.Blocked else "no"}',
-                                        description=f'Enter to {"un" if device.Blocked else ""}block',
-                                        highlightable=False,
-                                        on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                                        'last_input': arg,
-                                                                        'action': Action.CHANGE_DEVICE_BLOCKED,
-                                                                        'device': address,
-                                                                        'from_paired': from_paired,
-                                                                        'blocked': not device.Blocked},
-                                                                       keep_app_open=True))
-                ])
-
-            if args[2] == 'alias':
-                items = []
-                if len(args) == 3:
-                    items.append(ExtensionResultItem(icon=icon,
-                                                     name='Enter new alias...',
-                                                     description=f'Device: {device.Name}',
-                                                     highlightable=False,
-                                                     on_enter=DoNothingAction()))
-                else:
-                    alias = ' '.join(args[3:])
-                    items.append(ExtensionResultItem(
-                        icon=icon,
-                        name=f'Set the new alias: {alias}',
-                        description=f'Device: {device.Name}',
-                        highlightable=False,
-                        on_enter=ExtensionCustomAction({'keyword': keyword,
-                                                        'last_input': arg,
-                                                        'action': Action.CHANGE_DEVICE_ALIAS,
-                                                        'device': address,
-                                                        'from_paired': from_paired,
-                                                        'alias': alias}, keep_app_open=True)
-                    ))
-
-                items.append(go_back_item(keyword, name='Cancel', new_input=f'{args[0]} {address}'))
-                return RenderResultListAction(items)
+        hidden = len(snapshot.nearby) - len(snapshot.ranked)
+        if hidden > 0:
+            items.append(ExtensionResultItem(icon='images/icon.png',
+                                             name=f'{hidden} more devices with a weaker signal',
+                                             highlightable=False,
+                                             on_enter=DoNothingAction()))
+
+        return RenderResultListAction(items)
+
+    def render_device(self, query, address, from_paired):
+        device = query.snapshot.devices.get(address)
+        if device is None:
+            return
+        name = device.get('Name', device['Alias'])
+        connected, trusted, blocked = device['Connected'], device['Trusted'], device['Blocked']
+        favourite = address in self.favourites()
+        icon = get_icon(device)
+
+        status = [ExtensionResultItem(icon=icon,
+                                      name=line,
+                                      highlightable=False,
+                                      on_enter=DoNothingAction()) for line in device_status(query.snapshot, address)]
+        items = [
+            go_back_item(query.keyword, new_input='paired' if from_paired else ''),
+            ExtensionResultItem(icon='images/icon.png',
+                                name='Reload information',
+                                highlightable=False,
+                                on_enter=query.action(Action.RELOAD)),
+            ExtensionResultItem(icon=icon,
+                                name=f'Device: {name}',
+                                description=f'Address: {address}'
+                                            f'\nEnter to unpair',
+                                highlightable=False,
+                                on_enter=query.action(Action.UNPAIR, device=address, from_paired=from_paired)),
+            ExtensionResultItem(icon=icon,
+                                name=f'Connected: {"yes" if connected else "no"}',
+                                description='\n'.join([*connect_stats.summary(address),
+                                                       f'Enter to {"dis" if connected else ""}connect']),
+                                highlightable=False,
+                                on_enter=query.action(Action.DISCONNECT if connected else Action.CONNECT,
+                                                      device=address, from_paired=from_paired)),
+            *status,
+            ExtensionResultItem(icon=icon,
+                                name=f'Alias: {device["Alias"]}',
+                                description='Enter to change',
+                                highlightable=False,
+                                on_enter=query.set_query(f'{device_route(address, from_paired)} alias ')),
+            ExtensionResultItem(icon=icon,
+                                name=f'Trusted: {"yes" if trusted else "no"}',
+                                description=f'Enter to {"un" if trusted else ""}trust',
+                                highlightable=False,
+                                on_enter=query.action(Action.CHANGE_DEVICE_TRUSTED, device=address,
+                                                      from_paired=from_paired, trusted=not trusted)),
+            ExtensionResultItem(icon=icon,
+                                name=f'Blocked: {"yes" if blocked else "no"}',
+                                description=f'Enter to {"un" if blocked else ""}block',
+                                highlightable=False,
+                                on_enter=query.action(Action.CHANGE_DEVICE_BLOCKED, device=address,
+                                                      from_paired=from_paired, blocked=not blocked))
+        ]
+        if device['Paired']:
+            items.append(ExtensionResultItem(
+                icon=icon,
+                name=f'Favourite: {"yes" if favourite else "no"}',
+                description='Favourites are reconnected automatically when they drop'
+                            f'\nEnter to {"remove from" if favourite else "add to"} favourites',
+                highlightable=False,
+                on_enter=query.action(Action.TOGGLE_FAVOURITE, device=address, from_paired=from_paired)
+            ))
+        return RenderResultListAction(items)
+
+    def render_device_alias(self, query, address, from_paired, alias=None):
+        device = query.snapshot.devices.get(address)
+        if device is None:
+            return
+        return RenderResultListAction(alias_items(query, get_icon(device), Action.CHANGE_DEVICE_ALIAS,
+                                                  device_route(address, from_paired), alias,
+                                                  description=f'Device: {device.get("Name", device["Alias"])}',
+                                                  device=address, from_paired=from_paired))
+
+    def render_stats(self, query):
+        items = [go_back_item(query.keyword),
+                 ExtensionResultItem(icon='images/icon.png',
+                                     name='Reset statistics',
+                                     highlightable=False,
+                                     on_enter=query.action(Action.RESET_STATS))]
+        for name, histogram in stats.histograms():
+            description = (f'p50 <= {histogram.percentile(50):.2g} ms, p95 <= {histogram.percentile(95):.2g} ms, '
+                           f'max {histogram.max:.1f} ms, total {histogram.total:.0f} ms')
+            if histogram.bytes:
+                description += f'\n{histogram.bytes / histogram.count:.0f} bytes per call, {histogram.bytes} in total'
+            items.append(ExtensionResultItem(icon='images/icon.png',
+                                             name=f'{name}: {histogram.count}x',
+                                             description=description,
+                                             highlightable=False,
+                                             on_enter=DoNothingAction()))
+        return RenderResultListAction(items)
+
+    def render_search(self, query):
+        items = [go_back_item(query.keyword)]
+        for device in self.search_devices(query.snapshot, query.arg):
+            items.append(device_item(query, device, from_paired=False))
+        if len(items) == 1:
+            items.append(ExtensionResultItem(icon='images/icon.png',
+                                             name=f'No devices matching "{query.arg}"',
+                                             highlightable=False,
+                                             on_enter=DoNothingAction()))
+        return RenderResultListAction(items)
 
 
 class KeywordQueryEventListener(EventListener):
 
     def on_event(self, event: KeywordQueryEvent, extension: BluetoothExtension):
-        return extension.on_input(event.get_keyword(), event.get_argument())
+        keyword, arg = event.get_keyword(), event.get_argument()
+        extension.set_current(event, lambda: extension.on_input(keyword, arg),
+                              streaming=(arg or '').startswith('scanned'))
+        return extension.on_input(keyword, arg)
+
+
+class PreferencesUpdateEventListener(EventListener):
+
+    def on_event(self, event, extension: BluetoothExtension):
+        extension.apply_preferences()
 
 
 class ItemEnterEventListener(EventListener):
 
     def on_event(self, event: ItemEnterEvent, extension: BluetoothExtension):
-        bt_tools = extension.bt_tools
-        adapter = bt_tools.get_adapter()
+        with stats.span(f'enter {event.get_data()["action"].name}'):
+            return self.handle(event, extension)
+
+    @staticmethod
+    def handle(event, extension):
         data = event.get_data()
         keyword, last_input, action = data['keyword'], data['last_input'], data['action']
+        extension.set_current(event, lambda: extension.on_input(keyword, last_input),
+                              streaming=(last_input or '').startswith('scanned'))
+        if not extension.wait_for_bluetooth(ACTION_TIMEOUT):
+            extension.connect_bluetooth()
+            return extension.on_input(keyword, last_input)
+
+        bt_tools = extension.bt_tools
+        adapter_path = data.get('adapter')
+        adapter = bt_tools.get_adapter(adapter_path)
+
+        def device_state(name):
+            return (bt_tools.get_properties(data['device'], adapter_path) or {}).get(name)
 
         if action == Action.RELOAD:
             return set_input(extension, keyword, last_input, arg=last_input)
 
+        if action == Action.RESET_STATS:
+            stats.reset()
+            connect_stats.reset()
+            return set_input(extension, keyword, last_input, arg='stats')
+
+        if action == Action.SELECT_ADAPTER:
+            bt_tools.select_adapter(adapter_path)
+            return set_input(extension, keyword, last_input)
+
         if action == Action.TURN_ON:
-            if adapter is not None:
+            if bt_tools.is_powered(adapter_path):
                 return
-            subprocess.call(shlex.split(extension.preferences['command_on']), stdout=subprocess.DEVNULL)
-            if wait(lambda: bt_tools.get_adapter() is None, 0.25, 5):
-                return set_input(extension, keyword, last_input)
-            else:
-                return DoNothingAction()
+
+            def turn_on():
+                set_power(bt_tools, extension.preferences, True, adapter_path)
+                return ''
+
+            return extension.run_action(event, keyword, last_input, 'adapter', 'Turning Bluetooth on...', turn_on)
 
         if adapter is None:
             return set_input(extension, keyword, last_input)
 
         if action == Action.TURN_OFF:
-            subprocess.call(shlex.split(extension.preferences['command_off']), stdout=subprocess.DEVNULL)
-            if wait(lambda: bt_tools.get_adapter() is not None, 0.25, 5):
-                return set_input(extension, keyword, last_input)
-            else:
-                return DoNothingAction()
+            extension.remember_session(bt_tools.snapshot(adapter_path))
+
+            def turn_off():
+                set_power(bt_tools, extension.preferences, False, adapter_path)
+                return ''
+
+            return extension.run_action(event, keyword, last_input, 'adapter', 'Turning Bluetooth off...', turn_off)
+
+        def device_proxy(address):
+            device = bt_tools.get_device(address, adapter_path)
+            if device is None:
+                raise LookupError('The device is gone')
+            return device
+
+        def connect_device(address):
+            connect(bt_tools, address, adapter_path, connect_profile(extension.preferences), ACTION_TIMEOUT)
+            extension.frecency.record(address)
+
+        def disconnect_device(address):
+            extension.auto_reconnect.suppress(address)
+            device_proxy(address).Disconnect(timeout=ACTION_TIMEOUT)
+            extension.frecency.record(address)
+
+        if action == Action.CONNECT_TRUSTED:
+            devices = [device for device in bt_tools.snapshot(adapter_path).paired.values()
+                       if device['Trusted'] and not device['Connected'] and not device['Blocked']]
+            extension.run_bulk('Connecting trusted devices', devices, connect_device, 'Connecting...', 'Connected')
+            return set_input(extension, keyword, last_input, arg='bulk')
+
+        if action == Action.RECONNECT_SESSION:
+            snapshot = bt_tools.snapshot(adapter_path)
+            session_path, session = extension.last_session
+            devices = [snapshot.paired[address] for address in session if session_path == adapter_path
+                       and address in snapshot.paired and address not in snapshot.connected]
+            extension.run_bulk('Reconnecting last session', devices, connect_device, 'Connecting...', 'Connected')
+            return set_input(extension, keyword, last_input, arg='bulk')
+
+        if action == Action.DISCONNECT_ALL:
+            snapshot = bt_tools.snapshot(adapter_path)
+            extension.remember_session(snapshot)
+            extension.run_bulk('Disconnecting all devices', list(snapshot.connected.values()), disconnect_device,
+                               'Disconnecting...', 'Disconnected')
+            return set_input(extension, keyword, last_input, arg='bulk')
+
+        if action == Action.TOGGLE_FAVOURITE:
+            extension.toggle_favourite(data['device'])
+            return set_input(extension, keyword, last_input, arg=last_input)
+
+        if action == Action.TOGGLE_SELECTED:
+            with extension._lock:
+                extension.selected ^= {data['device']}
+                extension.invalidate()
+            return set_input(extension, keyword, last_input, arg=last_input)
+
+        if action == Action.UNPAIR_SELECTED:
+            paired = bt_tools.snapshot(adapter_path).paired
+            with extension._lock:
+                devices = [paired[address] for address in extension.selected if address in paired]
+                extension.selected.clear()
+                extension.invalidate()
+            extension.run_bulk('Unpairing devices', devices,
+                               lambda address: adapter.RemoveDevice(bt_tools.get_device_path(address, adapter_path),
+                                                                    timeout=ACTION_TIMEOUT),
+                               'Unpairing...', 'Unpaired')
+            return set_input(extension, keyword, last_input, arg='bulk')
 
         if action == Action.CHANGE_ADAPTER_ALIAS:
             adapter.Alias = data['alias']
@@ -607,78 +1139,87 @@ class ItemEnterEventListener(EventListener):
             return set_input(extension, keyword, last_input, arg='settings')
 
         if action == Action.START_SCAN:
-            if adapter.Discovering:
+            if bt_tools.get_adapter_properties(adapter_path)['Discovering']:
                 return set_input(extension, keyword, last_input)
-            adapter.StartDiscovery()
-            time.sleep(2)
-            return SetUserQueryAction(f'{keyword} scanned')
+            preferences = extension.preferences
+            extension.scanner.start(adapter_path, scan_duration(preferences), discovery_filter(preferences),
+                                    duty_cycle(preferences))
+            return set_input(extension, keyword, last_input, arg='scanned')
 
         if action == Action.STOP_SCAN:
-            if adapter.Discovering:
+            if not extension.scanner.stop(adapter_path) and adapter.Discovering:
                 adapter.StopDiscovery()
             return set_input(extension, keyword, last_input)
 
         if action == Action.CONNECT:
-            device = bt_tools.get_device(data['device'])
+            properties = bt_tools.get_properties(data['device'], adapter_path)
             redirect_failed = 'paired' if data['from_paired'] else ''
-            if not device:
+            if properties is None:
                 return set_input(extension, keyword, last_input, arg=redirect_failed)
-            redirect = f'device{"_p" if data["from_paired"] else ""} {device.Address}'
-            if device.Connected:
+            redirect = f'device{"_p" if data["from_paired"] else ""} {properties["Address"]}'
+            if properties['Connected']:
                 return set_input(extension, keyword, last_input, arg=redirect)
 
-            @timeout(5, timeout_exception=Exception)
-            def connect():
-                device.Connect()
+            def connect_single():
+                connect(bt_tools, data['device'], adapter_path, connect_profile(extension.preferences), ACTION_TIMEOUT)
+                extension.frecency.record(properties['Address'])
+                return redirect
 
-            # noinspection PyBroadException
-            try:
-                connect()
-                return set_input(extension, keyword, last_input, arg=redirect)
-            except Exception:
-                return set_input(extension, keyword, last_input, arg=redirect_failed)
+            return extension.run_action(event, keyword, last_input, data['device'],
+                                        f'Connecting to {properties["Alias"]}...', connect_single,
+                                        redirect_failed)
 
         if action == Action.DISCONNECT:
-            device = bt_tools.get_device(data['device'])
-            if not device:
+            properties = bt_tools.get_properties(data['device'], adapter_path)
+            if properties is None:
                 return set_input(extension, keyword, last_input)
-            if device.Connected:
-                device.Disconnect()
-                if not wait(lambda: device.Connected, 0.25, 5):
-                    return set_input(extension, keyword, last_input)
-            return set_input(extension, keyword, last_input,
-                             arg=f'device_p {device.Address}' if data['from_paired'] else '')
+            redirect = f'device_p {properties["Address"]}' if data['from_paired'] else ''
+            if not properties['Connected']:
+                return set_input(extension, keyword, last_input, arg=redirect)
+
+            def disconnect():
+                extension.auto_reconnect.suppress(properties['Address'])
+                bt_tools.get_device(data['device'], adapter_path).Disconnect(timeout=ACTION_TIMEOUT)
+                extension.frecency.record(properties['Address'])
+                if not bt_tools.wait_for(lambda: not device_state('Connected'), ACTION_TIMEOUT):
+                    return ''
+                return redirect
+
+            return extension.run_action(event, keyword, last_input, data['device'],
+                                        f'Disconnecting from {properties["Alias"]}...', disconnect, '')
 
         if action == Action.PAIR:
-            device = bt_tools.get_device(data['device'])
-            if not device:
+            properties = bt_tools.get_properties(data['device'], adapter_path)
+            if properties is None:
                 return set_input(extension, keyword, last_input, arg='scanned')
-            if device.Paired:
-                return set_input(extension, keyword, last_input, arg=f'device {device.Address}')
+            if properties['Paired']:
+                return set_input(extension, keyword, last_input, arg=f'device {properties["Address"]}')
 
-            @timeout(5, timeout_exception=Exception)
             def pair():
-                device.Pair()
+                bt_tools.get_device(data['device'], adapter_path).Pair(timeout=ACTION_TIMEOUT)
+                return f'device_p {properties["Address"]}'
 
-            # noinspection PyBroadException
-            try:
-                pair()
-                return set_input(extension, keyword, last_input, arg=f'device_p {device.Address}')
-            except Exception:
-                return set_input(extension, keyword, last_input, arg='paired')
+            return extension.run_action(event, keyword, last_input, data['device'],
+                                        f'Pairing with {properties["Alias"]}...', pair, 'paired')
 
         if action == Action.UNPAIR:
-            device = bt_tools.get_device(data['device'])
-            if not device:
-                return set_input(extension, keyword, last_input, arg='paired' if data['from_paired'] else '')
-            if not device.Paired:
+            properties = bt_tools.get_properties(data['device'], adapter_path)
+            redirect = 'paired' if data['from_paired'] else ''
+            if properties is None:
+                return set_input(extension, keyword, last_input, arg=redirect)
+            if not properties['Paired']:
                 return set_input(extension, keyword, last_input)
-            adapter.RemoveDevice(f'{device.Adapter}/dev_{device.Address.replace(":", "_")}')
-            wait(lambda: bt_tools.get_device(data['device']) is not None and device.Paired, 0.25, 5)
-            return set_input(extension, keyword, last_input, arg='paired' if data['from_paired'] else '')
+
+            def unpair():
+                adapter.RemoveDevice(bt_tools.get_device_path(data['device'], adapter_path), timeout=ACTION_TIMEOUT)
+                bt_tools.wait_for(lambda: not device_state('Paired'), ACTION_TIMEOUT)
+                return redirect
+
+            return extension.run_action(event, keyword, last_input, data['device'],
+                                        f'Unpairing {properties["Alias"]}...', unpair, redirect)
 
         if action == Action.CHANGE_DEVICE_ALIAS:
-            device = bt_tools.get_device(data['device'])
+            device = bt_tools.get_device(data['device'], adapter_path)
             if not device or not device.Paired:
                 return set_input(extension, keyword, last_input, arg='paired' if data['from_paired'] else '')
             device.Alias = data['alias']
@@ -686,7 +1227,7 @@ class ItemEnterEventListener(EventListener):
                              arg=f'device{"_p" if data["from_paired"] else ""} {data["device"]}')
 
         if action == Action.CHANGE_DEVICE_TRUSTED:
-            device = bt_tools.get_device(data['device'])
+            device = bt_tools.get_device(data['device'], adapter_path)
             if not device or not device.Paired:
                 return set_input(extension, keyword, last_input, arg='paired' if data['from_paired'] else '')
             device.Trusted = data['trusted']
@@ -694,7 +1235,7 @@ class ItemEnterEventListener(EventListener):
                              arg=f'device{"_p" if data["from_paired"] else ""} {data["device"]}')
 
         if action == Action.CHANGE_DEVICE_BLOCKED:
-            device = bt_tools.get_device(data['device'])
+            device = bt_tools.get_device(data['device'], adapter_path)
             if not device or not device.Paired:
                 return set_input(extension, keyword, last_input, arg='paired' if data['from_paired'] else '')
             device.Blocked = data['blocked']
@@ -702,23 +1243,5 @@ class ItemEnterEventListener(EventListener):
                              arg=f'device{"_p" if data["from_paired"] else ""} {data["device"]}')
 
 
-class Action(Enum):
-    RELOAD = 1
-    TURN_ON = 2
-    TURN_OFF = 3
-    CHANGE_ADAPTER_ALIAS = 4
-    CHANGE_DISCOVERABLE = 5
-    CHANGE_PAIRABLE = 6
-    START_SCAN = 7
-    STOP_SCAN = 8
-    CONNECT = 9
-    DISCONNECT = 10
-    PAIR = 11
-    UNPAIR = 12
-    CHANGE_DEVICE_ALIAS = 13
-    CHANGE_DEVICE_TRUSTED = 14
-    CHANGE_DEVICE_BLOCKED = 15
-
-
 if __name__ == '__main__':
     BluetoothExtension().run()
@@ -0,0 +1,130 @@
+import logging
+import random
+import threading
+
+from bt_tools import ADAPTER_IFACE, DEVICE_IFACE
+
+RECONNECT_BASE_DELAY = 2
+RECONNECT_MAX_DELAY = 300
+RECONNECT_MAX_ATTEMPTS = 10
+RECONNECT_TIMEOUT = 10
+# Disconnections started by a user on this host (bluetoothctl, the desktop settings) or on the device (its button).
+USER_DISCONNECT_REASONS = {'org.bluez.Reason.Local', 'org.bluez.Reason.Remote'}
+
+logger = logging.getLogger(__name__)
+
+
+def backoff(attempt):
+    # Exponential backoff with "equal jitter": at least half of the delay, so retries of several devices spread out.
+    delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class AutoReconnect:
+    """Reconnects favourite devices after they dropped, driven only by the signals BtTools forwards.
+
+    Disconnections a user started anywhere are told apart by the reason BlueZ reports. BlueZ before 5.82 reports
+    none, so there only disconnections through this extension are left alone.
+    """
+
+    def __init__(self, bt_tools, favourites):
+        self._bt_tools = bt_tools
+        # Called without arguments, returns the addresses of the favourite devices.
+        self._favourites = favourites
+        self._lock = threading.Lock()
+        # Device path -> (timer, attempt) of the next reconnection attempt.
+        self._timers = {}
+        # Addresses the user disconnected; they are left alone until they are connected again.
+        self._suppressed = set()
+        bt_tools.add_listener(self._on_state_changed)
+
+    def suppress(self, address):
+        with self._lock:
+            self._suppressed.add(address)
+        path = self._bt_tools.get_device_path(address)
+        if path is not None:
+            self._cancel(path)
+
+    def stop(self):
+        with self._lock:
+            timers, self._timers = self._timers, {}
+        for timer, _ in timers.values():
+            timer.cancel()
+
+    def _on_state_changed(self, path, iface, changed):
+        if iface == DEVICE_IFACE:
+            if changed is None:
+                self._cancel(path)
+            elif 'Connected' in changed:
+                if changed['Connected']:
+                    self._connected(path)
+                else:
+                    self._schedule(path, 0)
+        elif iface == ADAPTER_IFACE and changed and changed.get('Powered'):
+            for device in self._bt_tools.snapshot(path).paired.values():
+                if not device['Connected']:
+                    self._schedule(self._bt_tools.get_device_path(device['Address'], path), 0)
+
+    def _connected(self, path):
+        properties = self._properties(path)
+        if properties is not None:
+            with self._lock:
+                self._suppressed.discard(properties['Address'])
+        self._cancel(path)
+
+    def _properties(self, path):
+        return self._bt_tools.get_object_properties(path, DEVICE_IFACE)
+
+    def _cancel(self, path):
+        with self._lock:
+            timer, _ = self._timers.pop(path, (None, 0))
+        if timer is not None:
+            timer.cancel()
+
+    def _user_disconnected(self, path):
+        return self._bt_tools.get_disconnect_reason(path) in USER_DISCONNECT_REASONS
+
+    def _schedule(self, path, attempt):
+        properties = self._properties(path)
+        if properties is None or not properties['Paired'] or properties['Address'] not in self._favourites():
+            return
+        if self._user_disconnected(path):
+            logger.info('Not reconnecting %s, it was disconnected by the user', properties['Address'])
+            self._cancel(path)
+            return
+        if attempt >= RECONNECT_MAX_ATTEMPTS:
+            logger.info('Giving up reconnecting %s', properties['Address'])
+            self._cancel(path)
+            return
+        with self._lock:
+            if properties['Address'] in self._suppressed:
+                return
+            old, _ = self._timers.get(path, (None, 0))
+            if old is not None and attempt == 0:
+                return
+            timer = threading.Timer(backoff(attempt), self._reconnect, (path, attempt))
+            timer.daemon = True
+            self._timers[path] = timer, attempt
+        timer.start()
+
+    def _reconnect(self, path, attempt):
+        with self._lock:
+            entry = self._timers.get(path)
+            if entry is None or entry[1] != attempt:
+                return
+        properties = self._properties(path)
+        if properties is None or properties['Connected'] or not self._bt_tools.is_powered(properties['Adapter']):
+            self._cancel(path)
+            return
+        if self._user_disconnected(path):
+            self._cancel(path)
+            return
+
+        device = self._bt_tools.get_device(properties['Address'], properties['Adapter'])
+        # noinspection PyBroadException
+        try:
+            logger.info('Reconnecting %s (attempt %d)', properties['Address'], attempt + 1)
+            device.Connect(timeout=RECONNECT_TIMEOUT)
+        except Exception:
+            logger.info('Reconnecting %s failed', properties['Address'], exc_info=True)
+            self._schedule(path, attempt + 1)
@@ -0,0 +1,58 @@
+import re
+from collections import defaultdict
+
+_param_pattern = re.compile('{(\\w+):(\\w+)}')
+
+
+class Converter:
+
+    def __init__(self, convert, greedy=False):
+        self.convert = convert
+        # Greedy parameters take all remaining words and are left out if there are none.
+        self.greedy = greedy
+
+
+class Router:
+
+    def __init__(self, converters):
+        self._converters = converters
+        self._routes = defaultdict(list)
+        self._fallback = None
+
+    def add(self, pattern, handler, **defaults):
+        head, *words = pattern.split(' ')
+        parts = []
+        for word in words:
+            m = _param_pattern.fullmatch(word)
+            parts.append((m.group(1), self._converters[m.group(2)]) if m else (word, None))
+        self._routes[head].append((parts, handler, defaults))
+
+    def set_fallback(self, handler):
+        self._fallback = handler
+
+    def resolve(self, arg):
+        words = (arg or '').split(' ')
+        for parts, handler, defaults in self._routes.get(words[0], ()):
+            kwargs = self._match(parts, words[1:])
+            if kwargs is not None:
+                return handler, {**defaults, **kwargs}
+        return self._fallback, {}
+
+    @staticmethod
+    def _match(parts, words):
+        kwargs = {}
+        for i, (name, converter) in enumerate(parts):
+            if converter is None:
+                if i >= len(words) or words[i] != name:
+                    return None
+            elif converter.greedy:
+                text = ' '.join(words[i:])
+                if text.strip():
+                    kwargs[name] = converter.convert(text)
+                return kwargs
+            elif i >= len(words) or not words[i]:
+                return None
+            else:
+                kwargs[name] = converter.convert(words[i])
+        # Trailing spaces leave empty words behind, e.g. after "scanned ".
+        return kwargs if not any(words[len(parts):]) else None
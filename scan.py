@@ -0,0 +1,144 @@
+import logging
+import math
+import threading
+import time
+
+from bt_tools import ADAPTER_IFACE
+
+logger = logging.getLogger(__name__)
+
+
+class ScanSession:
+
+    def __init__(self, adapter_path, duration, discovery_filter, duty_cycle):
+        self.adapter_path = adapter_path
+        self.deadline = time.monotonic() + duration if duration else math.inf
+        self.discovery_filter = discovery_filter
+        # (seconds scanning, period in seconds), or None to scan until the deadline.
+        self.duty_cycle = duty_cycle
+        self.cycle_start = time.monotonic()
+        self.scanning = False
+        self.timer = None
+
+
+class ScanManager:
+    """Stops discovery when a scan session ends, and duty-cycles it while the list of scanned devices is open."""
+
+    def __init__(self, bt_tools, on_change):
+        self._bt_tools = bt_tools
+        # Called without arguments whenever the session starts or stops scanning, or ends.
+        self._on_change = on_change
+        self._lock = threading.Lock()
+        self._session = None
+        self._watching = False
+        bt_tools.add_listener(self._on_state_changed)
+
+    def start(self, adapter_path, duration, discovery_filter, duty_cycle=None):
+        self.stop()
+        session = ScanSession(adapter_path, duration, discovery_filter, duty_cycle)
+        self._bt_tools.start_discovery(adapter_path, **discovery_filter)
+        with self._lock:
+            session.scanning = True
+            self._session = session
+            # Starting a scan always opens the list of scanned devices.
+            self._watching = True
+        self._step(session)
+
+    def stop(self, adapter_path=None):
+        with self._lock:
+            session = self._session
+            if session is None or adapter_path not in (None, session.adapter_path):
+                return False
+            self._session = None
+        self._end(session)
+        return True
+
+    def active(self):
+        return self._session is not None
+
+    def status(self, adapter_path):
+        """Returns (seconds left, whether discovery is running) of the session on the adapter, or None."""
+        with self._lock:
+            session = self._session
+        if session is None or session.adapter_path != adapter_path:
+            return None
+        return max(0.0, session.deadline - time.monotonic()), session.scanning
+
+    def set_watching(self, watching):
+        with self._lock:
+            if watching == self._watching:
+                return
+            self._watching = watching
+            session = self._session
+            if session is None or session.duty_cycle is None:
+                return
+            if watching:
+                session.cycle_start = time.monotonic()
+        self._step(session)
+
+    def _on_state_changed(self, path, iface, changed):
+        if iface != ADAPTER_IFACE or (changed is not None and changed.get('Powered', True)):
+            return
+        # The adapter was turned off or removed, which ends discovery anyway.
+        with self._lock:
+            session = self._session
+            if session is None or session.adapter_path != path:
+                return
+            self._session = None
+            session.scanning = False
+        self._end(session)
+
+    def _end(self, session):
+        if session.timer is not None:
+            session.timer.cancel()
+        self._set_scanning(session, False)
+        logger.debug('Scan session on %s ended', session.adapter_path)
+        self._on_change()
+
+    def _step(self, session):
+        now = time.monotonic()
+        with self._lock:
+            if self._session is not session:
+                return
+            if now >= session.deadline:
+                self._session = None
+                ended = True
+            else:
+                ended = False
+                if session.duty_cycle is None:
+                    scanning, next_step = True, session.deadline
+                elif not self._watching:
+                    scanning, next_step = False, session.deadline
+                else:
+                    on, period = session.duty_cycle
+                    position = (now - session.cycle_start) % period
+                    scanning = position < on
+                    next_step = min(session.deadline, now + (on - position if scanning else period - position))
+                if next_step < math.inf:
+                    if session.timer is not None:
+                        session.timer.cancel()
+                    session.timer = threading.Timer(next_step - now, self._step, (session,))
+                    session.timer.daemon = True
+                    session.timer.start()
+        if ended:
+            self._end(session)
+        elif self._set_scanning(session, scanning):
+            self._on_change()
+
+    def _set_scanning(self, session, scanning):
+        with self._lock:
+            if session.scanning == scanning:
+                return False
+            session.scanning = scanning
+        # noinspection PyBroadException
+        try:
+            if scanning:
+                self._bt_tools.start_discovery(session.adapter_path, **session.discovery_filter)
+            else:
+                adapter = self._bt_tools.get_adapter(session.adapter_path)
+                if adapter is not None:
+                    adapter.StopDiscovery()
+        except Exception:
+            logger.warning('Could not %s discovery on %s', 'start' if scanning else 'stop', session.adapter_path,
+                           exc_info=True)
+        return True
@@ -0,0 +1,76 @@
+import re
+from collections import defaultdict
+
+MIN_SCORE = 0.5
+
+_separators = re.compile('[^0-9a-z]+')
+
+
+def _words(text: str):
+    return [word for word in _separators.split(text.lower()) if word]
+
+
+def _trigrams(words, prefix=False):
+    trigrams = set()
+    for i, word in enumerate(words):
+        padded = f'  {word}' if prefix and i == len(words) - 1 else f'  {word} '
+        trigrams.update(padded[j:j + 3] for j in range(len(padded) - 2))
+    return trigrams
+
+
+class SearchIndex:
+
+    def __init__(self):
+        self._texts = {}
+        self._trigrams = {}
+        self._postings = defaultdict(set)
+
+    def update(self, key, *texts):
+        text = ' '.join(_words(' '.join(t for t in dict.fromkeys(texts) if t)))
+        if self._texts.get(key) == text:
+            return
+        self.discard(key)
+        trigrams = _trigrams(text.split(' '))
+        self._texts[key], self._trigrams[key] = text, trigrams
+        for trigram in trigrams:
+            self._postings[trigram].add(key)
+
+    def discard(self, key):
+        self._texts.pop(key, None)
+        for trigram in self._trigrams.pop(key, ()):
+            postings = self._postings[trigram]
+            postings.discard(key)
+            if not postings:
+                del self._postings[trigram]
+
+    def clear(self):
+        self._texts.clear()
+        self._trigrams.clear()
+        self._postings.clear()
+
+    def search(self, query: str):
+        words = _words(query)
+        if not words:
+            return []
+        trigrams = _trigrams(words, prefix=True)
+        counts = defaultdict(int)
+        for trigram in trigrams:
+            for key in self._postings.get(trigram, ()):
+                counts[key] += 1
+
+        needle = ' '.join(words)
+        results = []
+        for key, count in counts.items():
+            score = count / len(trigrams)
+            if score < MIN_SCORE:
+                continue
+            text = self._texts[key]
+            if text.startswith(needle):
+                score += 2
+            elif needle in text:
+                score += 1
+            padded = f' {text} '
+            score += sum(0.1 for word in words if f' {word} ' in padded)
+            results.append((-score, len(text), key))
+        results.sort()
+        return [key for _, _, key in results]
@@ -0,0 +1,129 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+# Upper bounds of the histogram buckets in milliseconds, the last bucket takes everything above.
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUPS = 3
+
+logger = logging.getLogger('bluetooth.stats')
+logger.propagate = False
+
+
+class Histogram:
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count, self.total, self.max = 0, 0.0, 0.0
+        self.bytes = 0
+
+    def add(self, ms, size=0):
+        self.buckets[bisect.bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        self.bytes += size
+
+    def percentile(self, p):
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return 0.0
+
+
+class Stats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._log_handler = None
+        self.profile_dir = None
+
+    def add(self, name, ms, size=0):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(ms, size)
+        if self._log_handler is not None:
+            logger.info('%s %.3f ms %d bytes', name, ms, size)
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000)
+
+    @contextmanager
+    def profile(self, name):
+        if not self.profile_dir:
+            yield
+            return
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            path = Path(self.profile_dir).expanduser()
+            path.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(path / f'{time.strftime("%Y%m%d-%H%M%S")}-{time.monotonic_ns()}-{name}.prof')
+
+    def histograms(self):
+        with self._lock:
+            return sorted(self._histograms.items())
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def configure(self, log_file=None, profile_dir=None):
+        self.profile_dir = profile_dir or None
+        log_file = str(Path(log_file).expanduser()) if log_file else None
+        if self._log_handler is not None and self._log_handler.baseFilename == log_file:
+            return
+        if self._log_handler is not None:
+            logger.removeHandler(self._log_handler)
+            self._log_handler.close()
+            self._log_handler = None
+        if log_file:
+            self._log_handler = RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+            self._log_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            logger.addHandler(self._log_handler)
+            logger.setLevel(logging.INFO)
+
+
+class InstrumentedConnection:
+    """Wraps a Gio.DBusConnection and records the time and message size of every method call."""
+
+    def __init__(self, con, stats):
+        self._con = con
+        self._stats = stats
+
+    def call_sync(self, bus_name, object_path, interface_name, method_name, parameters, *args):
+        start, reply = time.perf_counter(), None
+        try:
+            reply = self._con.call_sync(bus_name, object_path, interface_name, method_name, parameters, *args)
+            return reply
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            size = sum(variant.get_size() for variant in (parameters, reply) if variant is not None)
+            self._stats.add(f'dbus {interface_name.rsplit(".", 1)[-1]}.{method_name}', ms, size)
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+
+stats = Stats()
@@ -0,0 +1,44 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def config_dir():
+    return Path(os.environ.get('XDG_CONFIG_HOME') or Path.home() / '.config') / 'ulauncher-bluetooth'
+
+
+class Settings:
+    """Small JSON file for state the extension changes itself, unlike the preferences which belong to Ulauncher."""
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else config_dir() / 'settings.json'
+        self._lock = threading.Lock()
+        self._data = self._load()
+
+    def _load(self):
+        try:
+            return json.loads(self.path.read_text())
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logger.warning('Could not read %s, starting with empty settings', self.path, exc_info=True)
+            return {}
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = self.path.with_suffix('.tmp')
+                tmp.write_text(json.dumps(self._data, indent=2))
+                os.replace(tmp, self.path)
+            except OSError:
+                logger.warning('Could not write %s', self.path, exc_info=True)